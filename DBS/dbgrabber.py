@@ -1,32 +1,109 @@
 import os
-import pickle
+import atexit
+import threading
 
 import DBS.eagleSqlTools as dbt
+from DBS.querycache import QueryCache
+from DBS.treestore import TreeStore
 
 USERID = "llight"
 PASSWORD = "CX2vy392"
 
+# Size the records cache, and separately the tree store, may grow to before old results are evicted
+CACHE_MAX_BYTES = 32 * 1024**3
+
+# How many times dbsPullSnaps pulls again a query evicted from the tree store before it could be loaded
+STORE_RETRIES = 2
+
+# Connections are kept per thread, an httplib connection can't be shared by threads
+# querying at the same time, eg the GUI's background jobs
+_connections = threading.local()
+_cache = None
+_store = None
+# Held while the shared cache and store are made, so every thread gets the same ones
+_lock = threading.RLock()
+
+def dbsConnection():
+    """Return the keep-alive connection shared by every query of the calling thread"""
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = _connections.connection = dbt.connect(USERID, PASSWORD, keep_alive=True)
+        atexit.register(connection.close)
+    return connection
+
+def dbsCache():
+    """Return the query cache kept under DBS/records"""
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = QueryCache(os.path.join(os.getcwd(), "DBS", "records"), CACHE_MAX_BYTES)
+        return _cache
+
+def dbsStore():
+    """Return the snapshot partitioned tree store kept under DBS/records/trees"""
+    global _store
+    with _lock:
+        if _store is None:
+            _store = TreeStore(os.path.join(dbsCache().root, "trees"), CACHE_MAX_BYTES)
+        return _store
+
 def dbsQuery(sql):
-    con = dbt.connect(USERID, PASSWORD)
+    con = dbsConnection()
     return dbt.execute_query(con,sql)
 
-def dbsPull(sql, fname, make=True, search=True):
-    if not fname[-2:] == ".p":
-        fname = fname + ".p"
-    cwd = os.getcwd()
-    path = os.path.join("records", fname)
-    path = os.path.join("DBS", path)
-    path = os.path.join(cwd, path)
-    try:
-        with open(path, "rb") as pfile:
+def dbsPull(sql, sim, make=True, search=True, mmap_mode="r"):
+    """Return the result of sql against sim, from the records cache when it has been pulled before
+
+    Args:
+        sql: The query to run
+        sim: The simulation the query is against, part of the cache key
+        make: Store the result in the cache after pulling it from the database
+        search: Look for the result in the cache before pulling it
+        mmap_mode: How to memory-map cached results, None to read them fully in to memory
+    Returns:
+        data: The record array of the result"""
+    cache = dbsCache()
+    key = cache.key(sql, sim)
+    if search:
+        data = cache.get(key, mmap_mode)
+        if data is not None:
             print "Pulling from records"
-            return pickle.load(pfile)
-    except:
-        f = open(path, "w")
-        f.close()
-        print "Pulling from DB"
-        data = dbsQuery(sql)
-        if make:
-            with open(path, "wb") as pfile:
-                pickle.dump(data, pfile)
-        return data
+            return data
+    print "Pulling from DB"
+    data = dbsQuery(sql)
+    if make:
+        cache.put(key, data, sim)
+    return data
+
+def dbsStoreKey(sql, sim):
+    """Make sure the tree store holds the result of sql, pulling it if needed, and return its key
+
+    The pull is split straight in to the store rather than also kept whole in the records cache."""
+    store = dbsStore()
+    key = dbsCache().key(sql, sim)
+    if not store.has(key):
+        store.build(key, dbsPull(sql, sim, make=False))
+    return key
+
+def dbsPullSnaps(sql, sim, snapnums, columns=None):
+    """Return only the given snapshots and columns of a merger tree pull
+
+    The first pull of a query sorts its result in to the tree store, later
+    pulls memory-map just the column files asked for, so every process
+    loading the same pull shares the one copy in the page cache.
+    Args:
+        sql: The merger tree query, its result must have a SnapNum column
+        sim: The simulation the query is against
+        snapnums: The snapshot numbers to load
+        columns (optional): The columns to load, defaults to all of them
+    Returns:
+        data: A DBS.treestore.TreeColumns of read only memory maps of the selected
+            columns, over the rows of the first to the last of the snapshots"""
+    for attempt in range(STORE_RETRIES + 1):
+        key = dbsStoreKey(sql, sim)
+        data = dbsStore().load(key, snapnums, columns)
+        if data is not None:
+            return data
+        # Evicted by another process since it was stored, pull it again
+    raise IOError("the tree store could not keep the pull %s of %s loaded, it may be bigger than "
+                  "CACHE_MAX_BYTES or have a bad meta.json" % (key, sim))
@@ -6,7 +6,12 @@
 import numpy as np
 import urllib
 import urllib2
+import urlparse
+import httplib
 import cookielib
+import socket
+import base64
+import zlib
 import re
 from getpass import getpass
 
@@ -20,6 +25,13 @@ numpy_dtype = {
     "nvarchar" : np.dtype("|S256")
     }
 
+# Number of bytes to read from the server at a time when parsing results
+read_chunk_size = 4 * 1024 * 1024
+
+# Values given to NULL or empty fields of numeric columns, as np.genfromtxt fills them
+missing_fields = ("", "NULL", "null")
+missing_fill = {"f": "nan", "i": "-1", "u": "0"}
+
 # Cookie storage - want to avoid creating a new session for every query
 cookie_file = "sql_cookies.txt"
 cookie_jar = cookielib.LWPCookieJar(cookie_file)
@@ -30,8 +42,12 @@ except IOError:
 
 
 class WebDBConnection:
-    def __init__(self, username, password=None):
-        """Class to store info required to connect to the web server"""
+    def __init__(self, username, password=None, keep_alive=False):
+        """Class to store info required to connect to the web server
+
+        With keep_alive set, all requests share one persistent HTTP/1.1
+        connection, ask for compressed results, and the cookie jar is
+        only saved when the connection is closed."""
         # Get password if necessary
         if password is None:
             password = getpass()
@@ -40,69 +56,300 @@ class WebDBConnection:
         # Set up authentication and cookies
         self.password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
         self.password_mgr.add_password(None, self.db_url, username, password)
-        self.opener = urllib2.OpenerDirector()
         self.auth_handler   = urllib2.HTTPBasicAuthHandler(self.password_mgr)
         self.cookie_handler = urllib2.HTTPCookieProcessor(cookie_jar)
+        self.opener = urllib2.build_opener(self.auth_handler, self.cookie_handler)
+        # Persistent connection state, only used in keep_alive mode
+        self.keep_alive = keep_alive
+        self.auth_header = "Basic " + base64.b64encode("%s:%s" % (username, password))
+        self.connection = None
 
-    def execute_query(self, sql):
-        """Run an SQL query and return the result as a record array"""
-        url = self.db_url + "?" + urllib.urlencode({'action': 'doQuery', 'SQL': sql})
-        urllib2.install_opener(urllib2.build_opener(self.auth_handler, self.cookie_handler))
-        response = urllib2.urlopen(url)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the persistent connection and save the session cookies"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
         cookie_jar.save(ignore_discard=True)
 
-        # Check for OK response
-        line = response.readline()
-        if line != "#OK\n":
-            raise Exception(response.readlines())
-
-        # Skip rows until we reach QUERYTIMEOUT
-        while True:
-            line = response.readline()
-            if line == "":
-                raise Exception("Unexpected end of file while reading result header")
-            elif line.startswith("#QUERYTIMEOUT"):
-                break
+    def open_url(self, url):
+        """Request url from the server and return a file-like response"""
+        if not self.keep_alive:
+            response = self.opener.open(url)
+            cookie_jar.save(ignore_discard=True)
+            return response
 
-        # Skip QUERYTIME
-        if not(response.readline().startswith("#QUERYTIME")):
-            raise Exception("Don't understand result header!")
-
-        # Read column info
-        # (also discards line with full list of column names)
-        columns = []
-        while True:
-            line = response.readline()
-            if line[0] != "#":
-                column_names = line
+        request = urllib2.Request(url)
+        request.add_header("Authorization", self.auth_header)
+        request.add_header("Accept-Encoding", "gzip, deflate")
+        request.add_header("Connection", "keep-alive")
+        cookie_jar.add_cookie_header(request)
+        # The server may drop a connection that has been idle, so retry once on a new one
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPConnection(urlparse.urlsplit(self.db_url).netloc)
+            try:
+                self.connection.request("GET", request.get_selector(), headers=dict(request.header_items()))
+                response = self.connection.getresponse()
                 break
-            else:
-                m = re.match("^#COLUMN ([0-9]+) name=([\w]+) JDBC_TYPE=(-?[0-9]+) JDBC_TYPENAME=([\w]+)$", line)
-                if m is not None:
-                    columns.append(m.groups())
-                else:
-                    raise Exception("Don't understand column info: "+line)
+            except (httplib.HTTPException, socket.error):
+                self.connection.close()
+                self.connection = None
+                if attempt > 0:
+                    raise
+        cookie_jar.extract_cookies(ResponseInfo(response), request)
+        if response.status != 200:
+            self.connection.close()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        return DecompressingReader(response, response.getheader("Content-Encoding"), self.connection)
 
-        # Construct record type for the output
-        dtype = np.dtype([(col[1],numpy_dtype[col[3]]) for col in columns])
+    def execute_query(self, sql):
+        """Run an SQL query and return the result as a record array"""
+        result = self.iter_query(sql)
+        data = np.empty(0, dtype=result.dtype)
+        nrows = 0
+        # Grow the output geometrically so the rows are only copied O(log N) times
+        for rows in result:
+            if nrows + len(rows) > len(data):
+                data.resize(max(2*len(data), nrows + len(rows)), refcheck=False)
+            data[nrows:nrows+len(rows)] = rows
+            nrows += len(rows)
+        data.resize(nrows, refcheck=False)
+        return data
 
-        # Return the data as a record array
-        return np.genfromtxt(response, dtype=dtype, delimiter=",")
+    def iter_query(self, sql, chunk_size=None):
+        """Run an SQL query and return a QueryResult iterating over record array batches"""
+        url = self.db_url + "?" + urllib.urlencode({'action': 'doQuery', 'SQL': sql})
+        return QueryResult(self.open_url(url), chunk_size)
 
     def fetch_docs(self, table):
         """Return a list of strings containing the documentation page for the specified table"""
         url = self.db_url + "/Help?" + urllib.urlencode({'page': "databases/"+"Eagle"+"/"+table})
-        urllib2.install_opener(urllib2.build_opener(self.auth_handler, self.cookie_handler))
-        response = urllib2.urlopen(url)
-        cookie_jar.save(ignore_discard=True)
-        return response.readlines()
+        response = self.open_url(url)
+        try:
+            return response.readlines()
+        finally:
+            response.close()
+
+
+class ResponseInfo(object):
+    """Gives an httplib response the info() method cookielib expects"""
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+
+class DecompressingReader(object):
+    def __init__(self, response, encoding=None, connection=None, block_size=64*1024):
+        """File-like reader that inflates a gzip or deflate encoded response as it is read
+
+        If the reader is closed before the whole body has been read, the
+        connection is closed too so it is never reused mid-response."""
+        self.response = response
+        self.encoding = encoding
+        self.connection = connection
+        self.block_size = block_size
+        if encoding == "gzip":
+            self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.inflater = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self.inflater = None
+        self.started = False
+        self.buffer = ""
+        self.eof = False
+
+    def _inflate(self, data):
+        if self.inflater is None:
+            return data
+        if self.encoding == "deflate" and not self.started:
+            # Some servers send raw deflate data without the zlib wrapper
+            self.started = True
+            try:
+                return self.inflater.decompress(data)
+            except zlib.error:
+                self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.inflater.decompress(data)
+
+    def _fill(self, size):
+        """Read from the response until the buffer holds size bytes or the body ends"""
+        while (size < 0 or len(self.buffer) < size) and not self.eof:
+            data = self.response.read(self.block_size)
+            if not data:
+                self.eof = True
+                if self.inflater is not None:
+                    self.buffer += self.inflater.flush()
+                break
+            self.buffer += self._inflate(data)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
 
+    def readline(self):
+        start = 0
+        while "\n" not in self.buffer[start:] and not self.eof:
+            start = len(self.buffer)
+            self._fill(start + 1)
+        end = self.buffer.find("\n") + 1
+        if end == 0:
+            end = len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
 
+    def readlines(self):
+        return self.read().splitlines(True)
 
-def connect(user, password=None):
+    def close(self):
+        if not self.eof and self.connection is not None:
+            self.connection.close()
+        self.response.close()
+
+
+def read_header(response):
+    """Read the result header from a query response and return its record type"""
+    # Check for OK response
+    line = response.readline()
+    if line != "#OK\n":
+        raise Exception(response.readlines())
+
+    # Skip rows until we reach QUERYTIMEOUT
+    while True:
+        line = response.readline()
+        if line == "":
+            raise Exception("Unexpected end of file while reading result header")
+        elif line.startswith("#QUERYTIMEOUT"):
+            break
+
+    # Skip QUERYTIME
+    if not(response.readline().startswith("#QUERYTIME")):
+        raise Exception("Don't understand result header!")
+
+    # Read column info
+    # (also discards line with full list of column names)
+    columns = []
+    while True:
+        line = response.readline()
+        if line[0] != "#":
+            column_names = line
+            break
+        else:
+            m = re.match("^#COLUMN ([0-9]+) name=([\w]+) JDBC_TYPE=(-?[0-9]+) JDBC_TYPENAME=([\w]+)$", line)
+            if m is not None:
+                columns.append(m.groups())
+            else:
+                raise Exception("Don't understand column info: "+line)
+
+    # Construct record type for the output
+    return np.dtype([(col[1],numpy_dtype[col[3]]) for col in columns])
+
+
+def parse_records(text, dtype):
+    """Convert a block of complete CSV lines into a record array"""
+    if "\r" in text:
+        text = text.replace("\r", "")
+    text = text.strip("\n")
+    if "\n\n" in text:
+        text = re.sub("\n+", "\n", text)
+    if text == "":
+        return np.empty(0, dtype=dtype)
+    ncols = len(dtype.names)
+    nrows = text.count("\n") + 1
+    # Split every field in one pass, then let numpy convert each column
+    fields = text.replace("\n", ",").split(",")
+    if len(fields) != nrows*ncols:
+        raise Exception("Don't understand result rows, expected %d columns" % ncols)
+    fields = np.asarray(fields).reshape(nrows, ncols)
+    rows = np.empty(nrows, dtype=dtype)
+    for index, name in enumerate(dtype.names):
+        column = fields[:, index]
+        fill = missing_fill.get(dtype[name].kind)
+        if fill is not None:
+            missing = np.zeros(nrows, dtype=bool)
+            for value in missing_fields:
+                missing |= column == value
+            if missing.any():
+                column = column.copy()
+                column[missing] = fill
+        rows[name] = column
+    return rows
+
+
+def iter_records(response, dtype, chunk_size=None):
+    """Iterate over the rows of a query response in record array batches
+
+    The response is read chunk_size bytes at a time, and any partial
+    line at the end of a chunk is carried over to the next one."""
+    if chunk_size is None:
+        chunk_size = read_chunk_size
+    tail = ""
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        chunk = tail + chunk
+        end = chunk.rfind("\n")
+        if end < 0:
+            tail = chunk
+            continue
+        tail = chunk[end+1:]
+        rows = parse_records(chunk[:end], dtype)
+        if len(rows) > 0:
+            yield rows
+    rows = parse_records(tail, dtype)
+    if len(rows) > 0:
+        yield rows
+
+
+class QueryResult(object):
+    def __init__(self, response, chunk_size=None):
+        """Iterator over the rows of a query response, in record array batches
+
+        Rows are yielded as soon as each chunk of the response has been
+        read, so callers can start on them before the download ends."""
+        self.response = response
+        try:
+            self.dtype = read_header(response)
+        except:
+            response.close()
+            raise
+        self.batches = iter_records(response, self.dtype, chunk_size)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self.batches)
+        except StopIteration:
+            self.close()
+            raise
+
+    __next__ = next
+
+    def close(self):
+        """Release the underlying response"""
+        self.response.close()
+
+
+def connect(user, password=None, keep_alive=False):
     """Connect to EAGLE database and return a connection object"""
-    return WebDBConnection(user, password)
+    return WebDBConnection(user, password, keep_alive)
 
 
 def execute_query(con, sql):
     return con.execute_query(sql)
+
+
+def iter_query(con, sql, chunk_size=None):
+    return con.iter_query(sql, chunk_size)
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+def normalise_sql(sql):
+    """Collapse the whitespace in an SQL string so formatting changes don't change its key"""
+    return " ".join(sql.split())
+
+
+def replace_file(src, dst):
+    """Move src over dst, atomically where the platform allows it"""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows won't rename over an existing file
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class FileLock(object):
+    def __init__(self, path):
+        """Exclusive lock on the file path, held between processes while used as a context manager
+
+        One FileLock can be shared by the threads of a process, they take
+        it in turn. It isn't reentrant."""
+        self.path = path
+        self.thread_lock = threading.Lock()
+        # The lock file open by the thread holding the lock
+        self.held = threading.local()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            lock_file = open(self.path, "a+")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except IOError:
+                            # LK_LOCK gives up after 10 seconds, keep waiting
+                            pass
+            except:
+                lock_file.close()
+                raise
+        except:
+            self.thread_lock.release()
+            raise
+        self.held.lock_file = lock_file
+        return self
+
+    def __exit__(self, *exc_info):
+        lock_file, self.held.lock_file = self.held.lock_file, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            lock_file.close()
+            self.thread_lock.release()
+        return False
+
+
+def touch_file(path):
+    """Set the modification time of path to now, the last hit of a cache entry"""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+class QueryCache(object):
+    def __init__(self, root, max_bytes):
+        """On-disk cache of query results, keyed by a hash of the normalised SQL and the sim
+
+        Results are stored as .npy files so they can be memory-mapped back
+        in. A small JSON index records the rows, bytes and fetch time of each
+        entry, and the least recently used entries are evicted once the cache
+        grows past max_bytes. A hit only sets the modification time of the
+        entry's file, so reads never rewrite the index. The index is only
+        changed under a lock file, so many processes can share the cache."""
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, "index.json")
+        self.lock = FileLock(os.path.join(root, "index.lock"))
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, sql, sim):
+        """Return the cache key for a query against the simulation sim"""
+        return hashlib.sha1(sim + "\n" + normalise_sql(sql)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + ".npy")
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as ifile:
+                return json.load(ifile)
+        except (IOError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.root)
+        with os.fdopen(fd, "w") as ifile:
+            json.dump(index, ifile, indent=1, sort_keys=True)
+        replace_file(tmp_path, self.index_path)
+
+    def get(self, key, mmap_mode="r", touch=True):
+        """Return the cached result for key, memory-mapped if mmap_mode is set, or None on a miss"""
+        path = self.path(key)
+        # Under the lock so the file can't be evicted between finding and opening it
+        with self.lock:
+            if not os.path.exists(path):
+                return None
+            data = np.load(path, mmap_mode=mmap_mode)
+            if touch:
+                touch_file(path)
+        return data
+
+    def put(self, key, data, sim=None):
+        """Atomically store data under key, then evict old entries if the cache is too big"""
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.root)
+        with os.fdopen(fd, "wb") as dfile:
+            np.save(dfile, data)
+            dfile.flush()
+            os.fsync(dfile.fileno())
+        with self.lock:
+            replace_file(tmp_path, self.path(key))
+            index = self.load_index()
+            index[key] = {"sim": sim, "rows": len(data), "bytes": os.path.getsize(self.path(key)),
+                          "fetched": time.time()}
+            self.evict(index, keep=key)
+            self.save_index(index)
+
+    def last_hit(self, key, entry):
+        """When the entry was last hit, from the modification time of its file"""
+        try:
+            return os.path.getmtime(self.path(key))
+        except OSError:
+            return entry["fetched"]
+
+    def evict(self, index, keep=None):
+        """Remove the least recently hit entries from index and disk until it fits in max_bytes
+
+        Must be called holding the lock."""
+        total = sum(entry["bytes"] for entry in index.values())
+        by_age = sorted(index, key=lambda k: self.last_hit(k, index[k]))
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+            except OSError:
+                # Still mapped by another process on Windows, try again next time
+                continue
+            total -= index.pop(key)["bytes"]
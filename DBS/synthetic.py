@@ -0,0 +1,111 @@
+import numpy as np
+
+import DBS.eagleSqlTools as dbt
+
+# Columns of storyB_V2.storyboard_sql, with the JDBC types the database reports for them
+STORYBOARD_COLUMNS = [("ID", "bigint"), ("DesID", "bigint"), ("GalaxyID", "bigint"), ("SnapNum", "int"),
+                      ("MassType_DM", "real"), ("x", "float"), ("y", "float"), ("z", "float"),
+                      ("Redshift", "real")]
+STORYBOARD_DTYPE = np.dtype([(name, dbt.numpy_dtype[typename]) for name, typename in STORYBOARD_COLUMNS])
+
+# Expansion factor of each of the 29 snapshots
+EXPANSION_F_SNAPS = np.array([0.05, 0.06, 0.09, 0.10, 0.11, 0.12, 0.14, 0.15, 0.17,
+                              0.18, 0.20, 0.22, 0.25, 0.29, 0.31, 0.33, 0.37, 0.40,
+                              0.44, 0.50, 0.54, 0.58, 0.62, 0.67, 0.73, 0.79, 0.85,
+                              0.91, 1.00])
+LAST_SNAP = len(EXPANSION_F_SNAPS) - 1
+
+
+def synthetic_trees(n_halos, boxsize=25 * 0.6777, merger_rate=0.15, min_mass=1.0e10, step=0.3, seed=0):
+    """Make a merger tree pull with the same layout as the storyboard SQL, without the database
+
+    Every z=0 halo has a main branch back to the snapshot it formed in,
+    and satellites that merge in to the main branch, each a branch of its
+    own. GalaxyIDs are numbered depth first as in the EAGLE trees, so the
+    whole tree of a halo lies between its GalaxyID and LastProgID, and
+    DesID links every galaxy to its descendant in the next snapshot.
+    Positions random walk back in time and wrap in the periodic box.
+
+    Args:
+        n_halos: The number of z=0 halos, each above min_mass
+        boxsize: The size of the periodic box, in the units of the x, y and z columns
+        merger_rate: The mean number of satellites merging in per main branch snapshot
+        min_mass: The DM mass cut of the z=0 halos
+        step: The typical distance a galaxy moves between snapshots
+        seed: Seed for the random numbers, the same seed gives the same trees
+    Returns:
+        data: Record array with STORYBOARD_DTYPE, ordered by ID as the SQL is"""
+    rng = np.random.RandomState(seed)
+    halos = np.arange(n_halos)
+
+    # Main branches, from the snapshot each halo formed in to z=0
+    first_snap = np.minimum(rng.geometric(0.3, n_halos) - 1, LAST_SNAP)
+    main_len = LAST_SNAP + 1 - first_snap
+    root_mass = np.minimum(min_mass * (rng.pareto(0.9, n_halos) + 1), 1.0e14)
+
+    # Satellites, each merging in to the main branch galaxy at its attach snapshot
+    n_sats = rng.poisson(merger_rate * (main_len - 1))
+    sat_halo = np.repeat(halos, n_sats)
+    sat_attach = first_snap[sat_halo] + 1 + np.floor(rng.rand(len(sat_halo)) * (main_len[sat_halo] - 1)).astype(int)
+    sat_len = np.minimum(rng.geometric(0.4, len(sat_halo)), sat_attach)
+    # Depth first, the satellites merging deepest in the tree come first
+    order = np.lexsort((sat_attach, sat_halo))
+    sat_halo, sat_attach, sat_len = sat_halo[order], sat_attach[order], sat_len[order]
+
+    # Number the galaxies of each tree on from the tree before
+    tree_len = main_len + np.bincount(sat_halo, weights=sat_len, minlength=n_halos).astype(int)
+    root_ids = np.r_[0, np.cumsum(tree_len)[:-1]]
+    before = np.cumsum(sat_len) - sat_len
+    sat_ids = root_ids[sat_halo] + main_len[sat_halo] + before - before[np.searchsorted(sat_halo, sat_halo)]
+
+    # Every branch as its first ID, length, snapshot of its first ID and the descendant of that,
+    # the main branches first
+    branch_ids = np.r_[root_ids, sat_ids]
+    branch_len = np.r_[main_len, sat_len]
+    branch_top = np.r_[np.full(n_halos, LAST_SNAP), sat_attach - 1]
+    branch_des = np.r_[np.full(n_halos, -1), root_ids[sat_halo] + LAST_SNAP - sat_attach]
+    branch_halo = np.r_[halos, sat_halo]
+    branch_start = np.cumsum(branch_len) - branch_len
+
+    # One row per galaxy, k snapshots back from the start of its branch
+    n_rows = int(branch_len.sum())
+    row_branch = np.repeat(np.arange(len(branch_ids)), branch_len)
+    row_k = np.arange(n_rows) - branch_start[row_branch]
+    ids = branch_ids[row_branch] + row_k
+    snaps = branch_top[row_branch] - row_k
+
+    # Main branches lose mass going back in time, satellites are a fraction of their host
+    growth = rng.uniform(0.05, 0.3, n_halos)[branch_halo]
+    branch_mass = np.r_[root_mass, root_mass[sat_halo] * np.exp(-growth[sat_halo] * (LAST_SNAP - sat_attach))
+                        * 10**rng.uniform(-2., -0.3, len(sat_halo))]
+    masses = branch_mass[row_branch] * np.exp(-growth[row_branch] * row_k)
+
+    # Positions random walk back from the start of each branch, satellites start off near their host
+    steps = rng.randn(n_rows, 3) * step
+    steps[row_k == 0] = 0.
+    walk = np.cumsum(steps, axis=0)
+    walk -= walk[branch_start][row_branch]
+    starts = np.empty((len(branch_ids), 3))
+    starts[:n_halos] = rng.rand(n_halos, 3) * boxsize
+    host_rows = branch_start[sat_halo] + LAST_SNAP - sat_attach
+    starts[n_halos:] = starts[sat_halo] + walk[host_rows] + rng.randn(len(sat_halo), 3) * step * 3
+    positions = np.mod(starts[row_branch] + walk, boxsize)
+
+    # The IDs run from 0 to n_rows-1, so putting each row at its ID orders them by ID as the SQL does
+    data = np.empty(n_rows, dtype=STORYBOARD_DTYPE)
+    data["ID"][ids] = ids
+    data["DesID"][ids] = np.where(row_k == 0, branch_des[row_branch], ids - 1)
+    data["GalaxyID"][ids] = root_ids[branch_halo[row_branch]]
+    data["SnapNum"][ids] = snaps
+    data["MassType_DM"][ids] = masses
+    data["x"][ids] = positions[:, 0]
+    data["y"][ids] = positions[:, 1]
+    data["z"][ids] = positions[:, 2]
+    data["Redshift"][ids] = 1. / EXPANSION_F_SNAPS[snaps] - 1.
+    return data
+
+
+def halos_for_rows(n_rows, **kwargs):
+    """Estimate how many halos synthetic_trees needs to make about n_rows rows"""
+    trial = synthetic_trees(1000, **kwargs)
+    return max(int(round(n_rows * 1000. / len(trial))), 1)
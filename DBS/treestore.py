@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+from DBS.querycache import FileLock, touch_file
+
+# Bumped when the on-disk layout changes, so pulls stored by older versions are rebuilt
+LAYOUT = 2
+
+
+class TreeColumns(object):
+    def __init__(self, columns, dtype, sorted_by=()):
+        """Read only table of memory-mapped columns, standing in for a record array
+
+        Indexing with a column name gives that column without copying it, so
+        every process that maps the same store shares one copy of the data in
+        the page cache. Indexing with rows gives a record array of just those rows.
+        Args:
+            columns: Dict of column name to array, all the same length
+            dtype: The record dtype of the table
+            sorted_by: The columns the rows are sorted by, most significant first"""
+        self.columns = columns
+        self.dtype = dtype
+        self.sorted_by = tuple(sorted_by)
+
+    def __len__(self):
+        return len(self.columns[self.dtype.names[0]]) if self.dtype.names else 0
+
+    def __getitem__(self, item):
+        if isinstance(item, basestring):
+            return self.columns[item]
+        rows = np.asarray(item)
+        data = np.empty(np.count_nonzero(rows) if rows.dtype == bool else len(rows), dtype=self.dtype)
+        for name in self.dtype.names:
+            data[name] = self.columns[name][rows]
+        return data
+
+
+class TreeStore(object):
+    def __init__(self, root, max_bytes):
+        """Columnar on-disk store of merger tree pulls, sorted by snapshot
+
+        Each pull is kept under root/<key> with one .npy file per column. The
+        rows are sorted by SnapNum then ID, and meta.json holds where each
+        snapshot's rows start, so a loader can memory-map only the columns it
+        needs and take the snapshots it wants as a slice, never reading the
+        whole tree in. As with QueryCache, a load sets the modification time
+        of the pull's meta.json, and the least recently loaded pulls are
+        removed under a lock file once the store grows past max_bytes."""
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = FileLock(os.path.join(root, "store.lock"))
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.path(key), "meta.json"))
+
+    def has(self, key):
+        try:
+            return self.meta(key).get("layout") == LAYOUT
+        except (IOError, ValueError):
+            return False
+
+    def meta(self, key):
+        with open(os.path.join(self.path(key), "meta.json"), "r") as mfile:
+            return json.load(mfile)
+
+    def keys(self):
+        return [key for key in os.listdir(self.root) if "." not in key and self.exists(key)]
+
+    def size(self, key):
+        """Bytes on disk of the pull key"""
+        meta = self.meta(key)
+        if "bytes" in meta:
+            return meta["bytes"]
+        return sum(os.path.getsize(os.path.join(dirpath, fname))
+                   for dirpath, dirnames, fnames in os.walk(self.path(key)) for fname in fnames)
+
+    def build(self, key, data):
+        """Sort the record array data by SnapNum and ID and write it out column by column"""
+        tmp_dir = self.path(key) + ".tmp%d" % os.getpid()
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        sorted_by = [name for name in ("SnapNum", "ID") if name in data.dtype.names]
+        #Stable sort keeps rows with the same keys in their pulled order
+        order = np.lexsort([np.asarray(data[name]) for name in reversed(sorted_by)])
+        snapnums = np.asarray(data["SnapNum"])[order]
+        snaps, starts, counts = np.unique(snapnums, return_index=True, return_counts=True)
+        for name in data.dtype.names:
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(data[name])[order])
+        meta = {"layout": LAYOUT,
+                "dtype": [(name, data.dtype[name].str) for name in data.dtype.names],
+                "sorted_by": sorted_by,
+                "snaps": dict(("%i" % snap, [int(start), int(count)]) for snap, start, count in zip(snaps, starts, counts)),
+                "bytes": sum(os.path.getsize(os.path.join(tmp_dir, name + ".npy")) for name in data.dtype.names)}
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as mfile:
+            json.dump(meta, mfile, indent=1, sort_keys=True)
+        with self.lock:
+            removed = []
+            if self.has(key):
+                #Another process got there first
+                removed.append(tmp_dir)
+            else:
+                if os.path.exists(self.path(key)):
+                    #Stored by an older layout
+                    removed.append(self.path(key) + ".old%d" % os.getpid())
+                    os.rename(self.path(key), removed[-1])
+                os.rename(tmp_dir, self.path(key))
+                removed.extend(self.evict(keep=key))
+        for old_dir in removed:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    def evict(self, keep=None):
+        """Move the least recently loaded pulls aside until the store fits in max_bytes
+
+        Must be called holding the lock. Returns the directories moved aside, to
+        be deleted once the lock is released."""
+        sizes = dict((key, self.size(key)) for key in self.keys())
+        total = sum(sizes.values())
+        removed = []
+        for key in sorted(sizes, key=lambda k: os.path.getmtime(os.path.join(self.path(k), "meta.json"))):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            old_dir = self.path(key) + ".old%d" % os.getpid()
+            try:
+                os.rename(self.path(key), old_dir)
+            except OSError:
+                # Still mapped by another process on Windows, try again next time
+                continue
+            removed.append(old_dir)
+            total -= sizes[key]
+        return removed
+
+    def load(self, key, snapnums, columns=None):
+        """Return a TreeColumns of the given columns for the rows of the given snapshots
+
+        The columns are read only memory maps of the store, sliced to the rows
+        from the first to the last of the snapshots, so nothing is copied.
+        Returns None if the pull isn't in the store, eg it has been evicted."""
+        # Under the lock so the pull can't be evicted while its files are opened
+        with self.lock:
+            if not self.has(key):
+                return None
+            touch_file(os.path.join(self.path(key), "meta.json"))
+            meta = self.meta(key)
+            dtype = np.dtype([(str(name), str(fmt)) for name, fmt in meta["dtype"]
+                              if columns is None or name in columns])
+            spans = [meta["snaps"]["%i" % snap] for snap in snapnums if "%i" % snap in meta["snaps"]]
+            if spans:
+                rows = slice(min(start for start, count in spans), max(start + count for start, count in spans))
+            else:
+                rows = slice(0, 0)
+            return TreeColumns(dict((name, np.load(os.path.join(self.path(key), name + ".npy"), mmap_mode="r")[rows])
+                                    for name in dtype.names), dtype, meta["sorted_by"])
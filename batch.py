@@ -0,0 +1,221 @@
+'''Generates and renders many flights from the command line, without the GUI or a display.
+
+The flights are listed in a JSON manifest, each with the flight script to generate it from and the
+simulation to render it against. Any key of "defaults" applies to every flight that doesn't set it:
+
+    {"defaults": {"sim": "RefL0025N0376", "renderer": "raster"},
+     "flights": [{"script": "orbit.txt"},
+                 {"script": "flyby.txt", "sim": "RefL0100N1504", "animation": "flyby.png"},
+                 {"flight": "old_flight.txt"}]}
+
+Flight keys:
+    script: The flight script, a text file of the rows of the GUI data table, ie the inp_data of
+        flightplan_generator.create_flight_path. The flight is generated from it when the flight file
+        is missing or older than the script
+    flight: The flight file to generate and render, defaults to the script name with utils.FLIGHT_EXT.
+        Without a script, an existing flight file to render
+    sim: The simulation code, rendered against and saved in the header of generated flights, defaults to
+        RefL0025N0376
+    images: The images directory, defaults to an images directory named after the flight file as
+        the GUI does
+    mult_h: Multiply the distances in the script by h, as the GUI does, defaults to true
+    renderer, resume, animation, fps: As for storyB_V2.story_board
+Paths are relative to the manifest. Eg:
+
+    python batch.py flights.json --workers 16 --profile batch_trace.json
+
+The merger trees of each sim are pulled once, and the flights of a sim are rendered one after another
+on one pool of workers that keep the sim's tree loaded between flights. So every galaxy of the sim is
+pulled, rather than just those one flight looks at as storyB_V2.story_board does on its own.
+'''
+from __future__ import division
+
+import os
+import sys
+import json
+import argparse
+import traceback
+import multiprocessing
+
+import numpy as np
+
+import utils
+import render
+import profiling
+import storyB_V2
+import flightplan_generator as fg
+from DBS.dbgrabber import dbsStoreKey
+
+DEFAULT_SIM = "RefL0025N0376"
+
+
+def read_manifest(fname):
+    '''Reads the flights of a batch manifest, filling in the defaults
+    Args:
+        fname [str]: The JSON manifest
+    Returns:
+        flights [list]: Dict of the settings of each flight, with absolute paths'''
+    with open(fname, "r") as mfile:
+        manifest = json.load(mfile)
+    root = os.path.dirname(os.path.abspath(fname))
+    defaults = manifest.get("defaults", {})
+    flights = []
+    for index, entry in enumerate(manifest["flights"]):
+        flight = dict(defaults)
+        flight.update(entry)
+        #json gives unicode strings, which don't mix with the byte strings the frame hashes are made of
+        flight = dict((str(key), str(value) if isinstance(value, unicode) else value) for key, value in flight.items())
+        if "script" not in flight and "flight" not in flight:
+            raise ValueError("flight %i of %s has neither a script nor a flight file" % (index, fname))
+        for key in ("script", "flight", "images", "animation"):
+            if flight.get(key) is not None:
+                flight[key] = os.path.join(root, flight[key])
+        if flight.get("flight") is None:
+            flight["flight"] = os.path.splitext(flight["script"])[0] + utils.FLIGHT_EXT
+        if flight.get("images") is None:
+            flight["images"] = os.path.join(os.path.splitext(flight["flight"])[0], "images")
+        flight.setdefault("sim", DEFAULT_SIM)
+        flight.setdefault("mult_h", True)
+        flights.append(flight)
+    return flights
+
+
+def needs_generating(flight):
+    '''True if the flight has a script and its flight file is missing or older than the script'''
+    if flight.get("script") is None:
+        return False
+    if not os.path.exists(flight["flight"]):
+        return True
+    return os.path.getmtime(flight["flight"]) < os.path.getmtime(flight["script"])
+
+
+def generate_task(flight):
+    '''Generates one flight file from its script, returning the traceback if it fails'''
+    try:
+        inp_data = np.loadtxt(flight["script"], ndmin=2)
+        #create_flight_path prints as it goes, which is just noise from many workers
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            fg.create_flight_path(inp_data, flight["mult_h"], flight["flight"], sim=flight["sim"])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def generate_worker(task):
+    '''Worker process entry for generate_task, task being the flight and whether to profile it'''
+    flight, profile = task
+    profiling.worker_start(profile)
+    error = generate_task(flight)
+    return error, profiling.worker_records()
+
+
+def sim_snapnums(flights):
+    '''The snapshots any of the flights pass through, so one tree can be loaded for all of them'''
+    snapnums = set()
+    for flight in flights:
+        snapnums.update(utils.find_snapnum_range(utils.read_flight_file(flight["flight"])[0][:,1]))
+    return np.array(sorted(snapnums), dtype=int)
+
+
+def run_batch(flights, workers=1, renderer=None, resume=None, stream_frames=4096):
+    '''Generates then renders every flight of a batch
+    Args:
+        flights [list]: The flights, from read_manifest
+        workers (optional) [int]: How many worker processes to generate and render on, 1 runs everything here
+        renderer (optional) [str]: Overrides the renderer of every flight
+        resume (optional) [bool]: Overrides resume for every flight
+        stream_frames (optional) [int]: As for storyB_V2.story_board
+    Returns:
+        failed [dict]: Flight file to a list of failures, a traceback for the flight as a whole or
+            (image number, traceback) for each frame that could not be rendered'''
+    failed = {}
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        to_generate = [flight for flight in flights if needs_generating(flight)]
+        print "generating %i of %i flights" % (len(to_generate), len(flights))
+        if pool is not None:
+            errors = []
+            for error, records in pool.map(generate_worker, [(flight, profiling.enabled()) for flight in to_generate]):
+                profiling.merge(records)
+                errors.append(error)
+        else:
+            errors = [generate_task(flight) for flight in to_generate]
+        for flight, error in zip(to_generate, errors):
+            if error is not None:
+                failed[flight["flight"]] = [error]
+
+        #the flights of each sim, in manifest order
+        sims = []
+        for flight in flights:
+            if flight["sim"] not in sims:
+                sims.append(flight["sim"])
+        for sim in sims:
+            sim_flights = [flight for flight in flights if flight["sim"] == sim and flight["flight"] not in failed]
+            if len(sim_flights) == 0:
+                continue
+            print "pulling the merger trees of %s for %i flights" % (sim, len(sim_flights))
+            try:
+                with profiling.stage("pull"):
+                    dbsStoreKey(storyB_V2.storyboard_sql(sim), sim)
+                snapnums = sim_snapnums(sim_flights)
+            except Exception:
+                for flight in sim_flights:
+                    failed[flight["flight"]] = [traceback.format_exc()]
+                continue
+
+            for flight in sim_flights:
+                print "rendering %s" % flight["flight"]
+                try:
+                    if not os.path.exists(flight["images"]):
+                        os.makedirs(flight["images"])
+                    failures = storyB_V2.story_board(os.path.join(flight["images"], "image_no_"), flight["flight"], sim,
+                                                     processes=workers, pool=pool,
+                                                     renderer=renderer or flight.get("renderer", "mpl"),
+                                                     resume=resume if resume is not None else flight.get("resume", True),
+                                                     animation=flight.get("animation"), fps=flight.get("fps", 25),
+                                                     stream_frames=stream_frames, snapnums=snapnums, pushdown=False)
+                except Exception:
+                    failed[flight["flight"]] = [traceback.format_exc()]
+                    continue
+                if failures:
+                    failed[flight["flight"]] = sorted(failures.items())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate and render the flights of a manifest without the GUI")
+    parser.add_argument("manifest", help="JSON manifest of the flights")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes to generate and render on, 1 runs everything in this process")
+    parser.add_argument("--renderer", choices=sorted(render.renderers),
+                        help="renderer for every flight, overriding the manifest")
+    parser.add_argument("--no-resume", action="store_true", help="render every frame, even those already rendered")
+    parser.add_argument("--stream-frames", type=int, default=4096, help="frames of a flight to read at a time")
+    parser.add_argument("--profile", help="file to write the time of every stage to, see profiling")
+    args = parser.parse_args(argv)
+
+    flights = read_manifest(args.manifest)
+    profiler = profiling.start(args.profile)
+    try:
+        failed = run_batch(flights, args.workers, args.renderer, False if args.no_resume else None, args.stream_frames)
+    finally:
+        profiling.stop(profiler)
+
+    print "%i of %i flights rendered without failures" % (len(flights) - len(failed), len(flights))
+    for fname in sorted(failed):
+        print "%s failed:" % fname
+        for failure in failed[fname]:
+            print failure if isinstance(failure, basestring) else "image %i:\n%s" % failure
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+'''Benchmarks the stages of flightplan_generator.create_flight_path on synthetic flight scripts.
+
+Scripts are made up of a mix of orbits, spirals, helices and straight fly-bys, with gaps between
+some of them for CombinedPath to fill with splines. The flight is generated chunk by chunk in to the
+binary flight format, as the GUI does, and each profiling stage of create_flight_path is timed summed
+over the chunks. The best of the repeats is written out as JSON, so runs can be compared across
+versions. Eg:
+
+    python bench_flightpath.py --segments 10 100 1000 --frames 1000 100000 1000000 --out bench.json
+'''
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import timeit
+
+import numpy as np
+
+import utils
+import profiling
+import flightplan_generator as fg
+
+SEGMENT_KINDS = ["orbit", "spiral", "helix", "line"]
+
+
+def synthetic_script(no_segments, no_frames, gap_fraction=0.3, boxsize=25., seed=0):
+    '''Makes an inp_data array for create_flight_path, laid out as in the GUI tables
+    Args:
+        no_segments [int]: Number of partial paths
+        no_frames [int]: Roughly how many frames the whole flight runs for
+        gap_fraction (optional) [real]: The fraction of segments followed by a long gap to be splined
+            over, the rest start the frame after the one before, which still leaves a short spline
+        boxsize (optional) [real]: Targets are placed uniformly in a box this size
+        seed (optional) [int]: Seed for the random numbers, the same seed gives the same script
+    Returns:
+        inp_data [array]: Rows of [st_fr,en_fr, st_sf,en_sf, targ_x,targ_y,targ_z, axis_x,axis_y,axis_z, rv,av, ro,ao, hv,ho]
+        kinds [list]: The kind of each segment'''
+    rng = np.random.RandomState(seed)
+    #share the frames out between the segments and the gaps after them
+    gaps = (rng.rand(no_segments) < gap_fraction) * 1.
+    gaps[-1] = 0
+    weights = rng.uniform(0.5, 1.5, no_segments) + gaps * rng.uniform(0.1, 0.3, no_segments)
+    spans = np.maximum(np.floor(weights / weights.sum() * no_frames), 4)
+    gap_lens = np.where(gaps > 0, np.maximum(np.floor(spans * 0.2), 3), 1)
+    seg_lens = spans - gap_lens
+
+    inp_data = np.zeros((no_segments, 16))
+    kinds = []
+    start = -1.
+    sfs = np.linspace(0.1, 1., no_segments + 1)
+    for index in range(no_segments):
+        end = start + seg_lens[index]
+        kind = SEGMENT_KINDS[rng.randint(len(SEGMENT_KINDS))]
+        axis = rng.randn(3)
+        rad_vel, ang_vel, rad_off, ang_off, hel_vel, hel_off = 0., 0., rng.uniform(1., 4.), rng.rand(), 0., 0.
+        if kind in ("orbit", "spiral", "helix"):
+            ang_vel = rng.choice([-1, 1]) / rng.uniform(50., 400.)
+        if kind == "spiral":
+            rad_vel = rng.uniform(-0.5, 0.5) * rad_off / seg_lens[index]
+        if kind in ("helix", "line"):
+            hel_vel = rng.uniform(-1., 1.) * 4. / seg_lens[index]
+            hel_off = -hel_vel * seg_lens[index] / 2
+        inp_data[index] = [start, end, sfs[index], sfs[index + 1]] + list(rng.rand(3) * boxsize) + list(axis) + \
+                          [rad_vel, ang_vel, rad_off, ang_off, hel_vel, hel_off]
+        kinds.append(kind)
+        start = end + gap_lens[index]
+    return inp_data, kinds
+
+
+class StageTimer(object):
+    '''Collects the best time of each named stage over repeated runs'''
+    def __init__(self):
+        self.times = {}
+        self.order = []
+
+    def time(self, name, func, *args):
+        start = timeit.default_timer()
+        result = func(*args)
+        self.record(name, timeit.default_timer() - start)
+        return result
+
+    def record(self, name, elapsed):
+        if name not in self.times:
+            self.order.append(name)
+            self.times[name] = elapsed
+        else:
+            self.times[name] = min(self.times[name], elapsed)
+
+    def add_records(self, records):
+        '''Adds the stage totals of one run, from profiling.worker_records'''
+        for name in records["order"]:
+            self.record(name, records["stats"][name][1])
+
+
+def run_stages(inp_data, timer, fname):
+    '''Generates the flight with create_flight_path, a chunk at a time in to the binary flight format,
+    with mult_h off, and records the time of each of its profiling stages summed over the chunks
+    Args:
+        inp_data [array]: The flight script, from synthetic_script
+        timer [StageTimer]: Records the time of each stage
+        fname [str]: Where the flight is written'''
+    #with a profile already recorded, create_flight_path adds its stages to it rather than starting its own
+    profiling.worker_start(True)
+    try:
+        fg.create_flight_path(np.copy(inp_data), False, fname)
+    finally:
+        timer.add_records(profiling.worker_records())
+
+
+def git_revision():
+    '''The commit of the code being benchmarked, if it can be found'''
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_case(no_segments, no_frames, repeats, seed, total):
+    '''Times every stage for one synthetic script, returning the JSON record of the case'''
+    inp_data, kinds = synthetic_script(no_segments, no_frames, seed=seed)
+    timer = StageTimer()
+    fd, fname = tempfile.mkstemp(suffix=utils.FLIGHT_EXT)
+    os.close(fd)
+    #create_flight_path prints as it goes, keep that out of the results
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        for repeat in range(repeats):
+            run_stages(inp_data, timer, fname)
+            if total:
+                #and again with nothing profiled
+                timer.time("create_flight_path", fg.create_flight_path, np.copy(inp_data), False, fname)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.remove(fname)
+    return {"segments": no_segments,
+            "frames": int(inp_data[-1,1] - 1),
+            "splined_gaps": int(np.sum(inp_data[1:,0] - inp_data[:-1,1] > 0)),
+            "kinds": dict((kind, kinds.count(kind)) for kind in SEGMENT_KINDS),
+            "seed": seed,
+            "repeats": repeats,
+            "stages": [{"name": name, "seconds": timer.times[name]} for name in timer.order]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark flight path generation on synthetic scripts")
+    parser.add_argument("--segments", type=int, nargs="+", default=[10, 100, 1000],
+                        help="numbers of partial paths in the scripts")
+    parser.add_argument("--frames", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="numbers of frames in the flights")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case, the best time is kept")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic scripts")
+    parser.add_argument("--no-total", action="store_true", help="don't also time create_flight_path as a whole")
+    parser.add_argument("--out", default="bench_flightpath.json", help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    results = {"benchmark": "flightpath",
+               "revision": git_revision(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "cases": []}
+    for no_segments in args.segments:
+        for no_frames in args.frames:
+            if no_frames < 8 * no_segments:
+                print "skipping %i segments in %i frames, too few frames" % (no_segments, no_frames)
+                continue
+            case = bench_case(no_segments, no_frames, args.repeat, args.seed, not args.no_total)
+            results["cases"].append(case)
+            print "%i segments, %i frames:" % (case["segments"], case["frames"])
+            for stage in case["stages"]:
+                print "    %-22s %10.4f s" % (stage["name"], stage["seconds"])
+    with open(args.out, "w") as ofile:
+        json.dump(results, ofile, indent=1, sort_keys=True)
+    print "results written to %s" % args.out
+
+
+if __name__ == "__main__":
+    main()
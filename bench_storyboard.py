@@ -0,0 +1,157 @@
+'''Benchmarks the stages of storyB_V2.story_board on synthetic merger trees, without the database.
+
+The trees come from DBS.synthetic, with the same dtype as the storyboard SQL, and the camera orbits
+the middle of the box while the scale factor runs through the snapshots. Every frame is taken through
+the same batch interpolation, frustum culling and projection as storyB_V2.render_frames, and a few of
+them are rendered with render_frames itself. The stages are timed with profiling, so they are the ones
+story_board reports, and the totals are written out as JSON so runs can be compared across versions. Eg:
+
+    python bench_storyboard.py --rows 10000 100000 1000000 10000000 --frames 100 --out bench.json
+'''
+from __future__ import division
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import timeit
+
+import numpy as np
+
+import utils
+import render
+import profiling
+import storyB_V2
+from DBS.synthetic import synthetic_trees, halos_for_rows
+from bench_flightpath import git_revision
+
+
+def orbit_flight(no_frames, boxsize, sf_range=(0.1, 1.)):
+    '''A flight circling the middle of the box, looking in at it, as rows of a flight file
+    Args:
+        no_frames [int]: Number of frames
+        boxsize [real]: The size of the periodic box
+        sf_range (optional) [tuple]: The scale factors at the first and last frames
+    Returns:
+        flight [array]: Rows of frame, expansion factor, coordinates, x_basis, y_basis, z_basis'''
+    thetas = np.linspace(0., 2*np.pi, no_frames, endpoint=False)
+    centre = np.full(3, boxsize / 2)
+    cam_positions = centre + np.c_[np.cos(thetas), np.sin(thetas), np.zeros(no_frames)] * boxsize / 3
+    z_basis = centre - cam_positions
+    z_basis /= np.linalg.norm(z_basis, axis=1)[:, None]
+    y_basis = np.tile([0., 0., 1.], (no_frames, 1))
+    x_basis = np.cross(y_basis, z_basis)
+    return np.c_[np.arange(no_frames), np.linspace(sf_range[0], sf_range[1], no_frames), cam_positions,
+                 x_basis, y_basis, z_basis]
+
+
+class StageTotals(object):
+    '''Adds up the time spent in each named stage over every frame'''
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.order = []
+
+    def time(self, name, func, *args):
+        start = timeit.default_timer()
+        result = func(*args)
+        elapsed = timeit.default_timer() - start
+        if name not in self.times:
+            self.order.append(name)
+            self.times[name] = 0.
+            self.calls[name] = 0
+        self.times[name] += elapsed
+        self.calls[name] += 1
+        return result
+
+    def add_records(self, records, prefix=""):
+        '''Adds in the stages of profiling.worker_records, with their names prefixed'''
+        for name in records["order"]:
+            calls, seconds, size, max_size = records["stats"][name]
+            if prefix + name not in self.times:
+                self.order.append(prefix + name)
+                self.times[prefix + name] = 0.
+                self.calls[prefix + name] = 0
+            self.times[prefix + name] += seconds
+            self.calls[prefix + name] += calls
+
+
+def bench_case(no_rows, no_frames, render_frames, renderers, seed, boxsize):
+    '''Times every stage for one synthetic tree, returning the JSON record of the case'''
+    region = storyB_V2.region
+    totals = StageTotals()
+    no_halos = halos_for_rows(no_rows, boxsize=boxsize, seed=seed)
+    dbs_data = totals.time("synthetic_trees", lambda: synthetic_trees(no_halos, boxsize, seed=seed))
+    flight = orbit_flight(no_frames, boxsize)
+    tree = totals.time("tree_index", utils.TreeIndex, dbs_data)
+    render_at = np.unique(np.linspace(0, no_frames - 1, min(render_frames, no_frames)).astype(int))
+    out_dir = tempfile.mkdtemp()
+    in_view = 0
+    try:
+        #every frame down the path of storyB_V2.render_frames, short of drawing it
+        profiling.worker_start(True)
+        try:
+            blocks = utils.batch_gal_interpolation(flight[:, 1], tree)
+            for frame_indices, All_galaxies, positions in profiling.timed_iter("interpolation", blocks):
+                with profiling.stage("cull_index", positions.shape[1]):
+                    culler = utils.FrustumCuller(positions, boxsize, region)
+                for j, i in enumerate(frame_indices):
+                    in_view += len(storyB_V2.frame_view(flight[i], All_galaxies, positions[j], culler, boxsize))
+        finally:
+            totals.add_records(profiling.worker_records())
+
+        #then some of the frames rendered as story_board does, each renderer's stages kept apart
+        for name in renderers:
+            profiling.worker_start(True)
+            try:
+                totals.time("render_frames_%s" % name, storyB_V2.render_frames, os.path.join(out_dir, name + "_"),
+                            render_at, flight[render_at], tree, boxsize, name)
+            finally:
+                totals.add_records(profiling.worker_records(), "render_frames_%s/" % name)
+    finally:
+        shutil.rmtree(out_dir)
+
+    return {"rows": len(dbs_data),
+            "frames": no_frames,
+            "mean_in_view": in_view / no_frames,
+            "seed": seed,
+            "stages": [{"name": name, "seconds": totals.times[name], "calls": totals.calls[name],
+                        "seconds_per_call": totals.times[name] / totals.calls[name]} for name in totals.order]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the story board stages on synthetic merger trees")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="approximate numbers of rows in the merger trees")
+    parser.add_argument("--frames", type=int, default=100, help="frames of the flight")
+    parser.add_argument("--render-frames", type=int, default=10, help="how many of the frames to also render")
+    parser.add_argument("--renderers", nargs="+", default=sorted(render.renderers), choices=sorted(render.renderers),
+                        help="renderers to time")
+    parser.add_argument("--boxsize", type=float, default=25 * storyB_V2.h, help="size of the periodic box")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic trees")
+    parser.add_argument("--out", default="bench_storyboard.json", help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    results = {"benchmark": "storyboard",
+               "revision": git_revision(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "cases": []}
+    for no_rows in args.rows:
+        case = bench_case(no_rows, args.frames, args.render_frames, args.renderers, args.seed, args.boxsize)
+        results["cases"].append(case)
+        print "%i rows, %i frames, %.0f galaxies in view per frame:" % (case["rows"], case["frames"], case["mean_in_view"])
+        for stage in case["stages"]:
+            print "    %-36s %10.4f s %6i calls" % (stage["name"], stage["seconds"], stage["calls"])
+    with open(args.out, "w") as ofile:
+        json.dump(results, ofile, indent=1, sort_keys=True)
+    print "results written to %s" % args.out
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 from __future__ import division
 
+import os
+
 import numpy as np
 
 import utils
+import profiling
 from utils import coord_transform, cross_basis, orthonormalise, Spline3D, Interp3D
 
 
@@ -32,6 +35,14 @@ class SplinePath(object):
         # print frame_set, "\n ----------\n", coords
         return coords
 
+    def deriv(self, frame_set):
+        '''generate the derivatives of the coordinates wrt frame number for given frame numbers
+        Args:
+            frame_set [array/real]: frame number/s to calculate the derivatives for
+        Returns:
+            derivs [array]: numpy array of derivatives [dx,dy,dz] for the frame numbers'''
+        return np.atleast_2d(self.spline.deriv(frame_set))
+
 class OrbitalPath(object):
     '''Generates paths central to a set of points, typically orbits, spirals of helical paths'''
     def __init__(self, centre_bundle, nx,ny,nz, rad_vel, rpf,
@@ -89,48 +100,60 @@ class OrbitalPath(object):
             coords [array]: numpy array of coords [x,y,z] for new frame numbers'''
         if mdf:
             frame_set = frame_set[:,0]
-        frame_set = np.asarray(frame_set) - self.init_frame
+        frame_set = np.atleast_1d(np.asarray(frame_set, dtype="f8")) - self.init_frame
         thetas = frame_set * self.ang_vel + self.ang_off
         radii = frame_set * self.rad_vel + self.rad_off
         #coords in obital axis frame
         frame_xs = radii     * np.cos(thetas)
         frame_ys = radii     * np.sin(thetas)
         frame_zs = frame_set * self.hel_vel + self.hel_off
-        frame_coords = np.asarray([frame_set, frame_xs, frame_ys, frame_zs]).T
-        #print frame_coords
-        #transform in to world coords
-        world_coords = []
-        for bundle in np.atleast_2d(frame_coords):
-            centre = self.centre_func(bundle[0])
-            frame_coord = bundle[1:]
-            frame_coord.shape = (3,1)
-            centre.shape = 3
-            world_coords.append(coord_transform(self.basis[0], self.basis[1], self.basis[2],
-                                       centre, frame_coord, inv=False, homog=False, tran=True))
-        world_coords = np.asarray(world_coords)
-        world_coords.shape = (len(world_coords), 3)
-        #print "obital path call"
+        frame_coords = np.asarray([frame_xs, frame_ys, frame_zs]).T
+        #transform in to world coords, for every frame at once. The rows of basis are the orbital
+        #axes in world coords, so this is the same as coord_transform with the centre as the origin
+        centres = self.centre_func(frame_set)
+        world_coords = centres + np.dot(frame_coords, self.basis)
         return world_coords
 
-def vector_derivs(frame_set, path_function, d_frame=0.01):
+    def deriv(self, frame_set):
+        '''generate the derivatives of the coordinates wrt frame number for given frame numbers,
+        differentiating the orbit in cylindrical coords and adding the motion of the centre
+        Args:
+            frame_set [array/real]: frame number/s to calculate the derivatives for
+        Returns:
+            derivs [array]: numpy array of derivatives [dx,dy,dz] for the frame numbers'''
+        frame_set = np.atleast_1d(np.asarray(frame_set, dtype="f8")) - self.init_frame
+        thetas = frame_set * self.ang_vel + self.ang_off
+        radii = frame_set * self.rad_vel + self.rad_off
+        frame_dxs = self.rad_vel * np.cos(thetas) - radii * self.ang_vel * np.sin(thetas)
+        frame_dys = self.rad_vel * np.sin(thetas) + radii * self.ang_vel * np.cos(thetas)
+        frame_dzs = np.full_like(frame_set, self.hel_vel)
+        frame_derivs = np.asarray([frame_dxs, frame_dys, frame_dzs]).T
+        return self.centre_func.deriv(frame_set) + np.dot(frame_derivs, self.basis)
+
+def vector_derivs(frame_set, path_function, d_frame=0.01, previous=None):
     '''Calculates the vector derivatives/ tangents to the path.
     Args:
         frame_set [real/s]: list of frame numbers to generate tangents at
         path_function [PathObject]: callable object defining the path. Takes any number of
-            frames as an arg, returning the pos at those frames
+            frames as an arg, returning the pos at those frames. If it has a deriv method
+            that is used for exact tangents, else they are found by central differences
         d_frame (optional) [real]: The dx used to find path difference
+        previous (optional) [array]: The tangent before the first frame, for when the path is done in chunks
     Returns:
         derivs [array]: array of tangent vectors, [dx,dy,dz] normalised'''
-    derivs = np.zeros((len(frame_set), 3))
-    for index in range(len(frame_set)):
-        frame_no = frame_set[index]
-        derivs[index] = path_function(frame_no + d_frame/2) - path_function(frame_no - d_frame/2)
-        if np.linalg.norm(derivs[index]) != 0:
-            pass
-        elif index == 0:
-            derivs[index] = np.asarray([0,0,1])
-        else:
-            derivs[index] = derivs[index - 1]
+    frame_set = np.asarray(frame_set, dtype="f8")
+    if hasattr(path_function, "deriv"):
+        derivs = path_function.deriv(frame_set)
+    else:
+        derivs = path_function(frame_set + d_frame/2) - path_function(frame_set - d_frame/2)
+    derivs = np.array(derivs, dtype="f8").reshape(len(frame_set), 3)
+    #where the path stands still, keep the previous tangent, or look along z if there is none
+    moving = np.linalg.norm(derivs, axis=1) != 0
+    if len(derivs) and not moving[0]:
+        derivs[0] = [0, 0, 1] if previous is None else previous
+        moving[0] = True
+    last_moving = np.maximum.accumulate(np.where(moving, np.arange(len(derivs)), 0))
+    derivs = derivs[last_moving]
     derivs /= np.linalg.norm(derivs, axis=1)[:, None]
     return derivs
 
@@ -168,6 +191,7 @@ class CombinedPath(object):
                 domains. Of the form [start_frame, end_frame, path_function]'''
         self.func_domain = func_domain
         self.fix_domain_holes()
+        self.build_segments()
         #print self.func_domain[:,1]
 
     def fix_domain_holes(self):
@@ -192,6 +216,40 @@ class CombinedPath(object):
                 new_func_domain.append(list(spl_func_dom))
         self.func_domain = np.asarray(new_func_domain)
 
+    def build_segments(self):
+        '''Internal function to split the frames in to segments between every domain start and end, once,
+        and find the path function used in each. Where domains overlap, as the splines from fix_domain_holes
+        do, the later domain is used. Segments in no domain get -1.'''
+        bounds = np.asarray(self.func_domain[:,:2], dtype="f8")
+        self.seg_edges = np.unique(bounds)
+        self.seg_funcs = np.full(max(len(self.seg_edges) - 1, 0), -1, dtype=int)
+        for index, (dom_s, dom_e) in enumerate(bounds):
+            first, last = np.searchsorted(self.seg_edges, [dom_s, dom_e])
+            self.seg_funcs[first:last] = index
+
+    def dispatch(self, frames, deriv=False):
+        '''Internal function to evaluate the path function of each frame's domain. Frames are put in
+        their segments with one binary search, and each path function is called once per run of
+        consecutive frames using it, so for sorted frames once per domain
+        Args:
+            frames [array]: Frame or set of frames to gen coords for
+            deriv (optional) [bool]: Gen derivatives from the path functions' deriv rather than coords
+        Returns:
+            out [array]: Set of coords/derivatives corrosponding to those frames, 0 outside every domain'''
+        frames = np.atleast_1d(np.asarray(frames, dtype="f8"))
+        out = np.zeros((len(frames), 3))
+        segs = np.searchsorted(self.seg_edges, frames, side="right") - 1
+        in_segs = (segs >= 0) * (segs < len(self.seg_funcs))
+        funcs = np.where(in_segs, self.seg_funcs[np.clip(segs, 0, max(len(self.seg_funcs) - 1, 0))], -1)
+        run_starts = np.r_[0, np.flatnonzero(np.diff(funcs)) + 1]
+        run_ends = np.r_[run_starts[1:], len(frames)]
+        for start, end in zip(run_starts, run_ends):
+            if len(frames) == 0 or funcs[start] < 0:
+                continue
+            func = self.func_domain[funcs[start], 2]
+            out[start:end] = func.deriv(frames[start:end]) if deriv else func(frames[start:end])
+        return out
+
     def __call__(self, frames):
         '''Use this class as a path function. For given frame values, it will apply a pathfunction
         to those frames to get coords. It chooses the path function that matches the domain
@@ -199,16 +257,26 @@ class CombinedPath(object):
             frames [array]: Frame or set of frames to gen coords for
         Returns:
             coords [array]: Set of coords corrosponding to those frames '''
-        conditions = []
-        frames = np.atleast_1d(frames)
-        for dom_s, dom_e, func in self.func_domain:
-            dom_mask = (frames >= dom_s) * (frames < dom_e)
-            conditions.append(dom_mask)
-        frames = np.asarray([list(frames)]*3, dtype="f8").T
-        out = np.piecewise(frames, conditions, self.func_domain[:,2], mdf=True)
-        return out
+        return self.dispatch(frames)
 
-def gen_look_bundle(t_data, no_frames):
+    def deriv(self, frames):
+        '''The derivative of the path wrt frame number, from the deriv of the path function
+        of each frame's domain. As for the coords, later domains take precedence where they overlap
+        Args:
+            frames [array]: Frame or set of frames to gen derivatives for
+        Returns:
+            derivs [array]: Set of derivatives [dx,dy,dz] corrosponding to those frames '''
+        return self.dispatch(frames, deriv=True)
+
+def log_weights(num, start, stop):
+    '''Elements start to stop of np.logspace(0, -2, num), without making the rest'''
+    if num == 1:
+        return np.ones(stop - start)
+    exps = np.arange(start, stop) * (-2. / (num - 1))
+    exps[np.arange(start, stop) == num - 1] = -2.
+    return np.power(10., exps)
+
+def gen_look_bundle(t_data, no_frames, start=0, stop=None):
     '''
     A "look bundle" is just and array of two coords to look at, and a weight.
     For each frame, the final look vector will be a linear combination of these two, weighted
@@ -216,8 +284,12 @@ def gen_look_bundle(t_data, no_frames):
     Args:
         t_data [array]: List of primary target coords and the domains they are defined for
             the scripted section of path [start_frame, end_frame, targ_x,y,z]
+        start, stop (optional) [int]: Only make the bundle for frames start to stop, so a long
+            flight can be done in chunks
     '''
-    look_bundle = np.zeros((no_frames, 7))
+    if stop is None:
+        stop = no_frames
+    look_bundle = np.zeros((stop - start, 7))
     tmp = np.asarray([[no_frames,no_frames,0.,0.,0.]])
     #print t_data, "\n---------\n", tmp
     t_data = np.r_[t_data, tmp]
@@ -232,13 +304,93 @@ def gen_look_bundle(t_data, no_frames):
         nds, nde, ntgx, ntgy, ntgz = t_data[index+1]
         nds, nde = int(nds), int(nde)
         ntg = np.asarray([ntgx,ntgy,ntgz])
-        look_bundle[cds:nds, :6] = np.r_[ctg,ntg]
-        look_bundle[cds:cde, 6] = 1
-        look_bundle[cde:nds, 6] = np.logspace(0,-2,nds-cde)
+        #the parts of the target's domain and the turn to the next target that are in this chunk
+        lo, hi = max(cds, start), min(nds, stop)
+        if lo < hi:
+            look_bundle[lo-start:hi-start, :6] = np.r_[ctg,ntg]
+        lo, hi = max(cds, start), min(cde, stop)
+        if lo < hi:
+            look_bundle[lo-start:hi-start, 6] = 1
+        lo, hi = max(cde, start), min(nds, stop)
+        if lo < hi:
+            look_bundle[lo-start:hi-start, 6] = log_weights(nds-cde, lo-cde, hi-cde)
     return look_bundle
 
-def create_flight_path(inp_data, mult_h, fname):
-    '''Creates a flight path from the data laid out in inp_data, and saves it as a txt under fname
+
+class FlightStream(object):
+    '''Sets up the path of a flight once, then generates its frames a chunk at a time, so long flights
+    never need every frame in memory and the frames can be used as they are made, eg by story_board'''
+    def __init__(self, inp_data, mult_h):
+        '''Args:
+            inp_data [array]: The partial paths of the flight, laid out as for create_flight_path
+            mult_h [bool]: Multiply the distances in inp_data by h'''
+        #Gen old style target array
+        h= 0.6777
+        inp_data = np.array(inp_data, dtype="f8")
+        if mult_h:
+            inp_data[:,[4,5,6,10,12,14,15]] = inp_data[:,[4,5,6,10,12,14,15]] * h
+        self.targ_data = np.copy(inp_data[:, [0,1,4,5,6]])
+        self.targ_data[0,0] = self.targ_data[0,0] + 1
+        self.targ_data[-1, 1] = self.targ_data[-1,1] - 1
+
+        self.no_frames = int(inp_data[-1,1] - 1)
+
+        #Split input data into chunks
+        dom = inp_data[:,:2]
+        no_frames_each = dom[:,1] - dom[:,0] + 1
+        #Get frames for each galaxy target
+        targ_frames = [np.arange(no_of_frames) + start for no_of_frames, start in zip(no_frames_each, dom[:,0])]
+        #Specify the centre of each orbital path
+        centre_bundles = [gen_centre_bundle(frame_set, central_coord) for frame_set, central_coord in zip(targ_frames, inp_data[:,4:7])]
+        #gen the path functions for each sub path and match to their resp frame domains
+        path_functions = [OrbitalPath(centre_bundle, *args) for centre_bundle, args in zip(centre_bundles, inp_data[:, 7:])]
+        dom_path_pair = np.c_[dom, path_functions]
+        #Gen a combined, piecewise path for the motion
+        self.path = CombinedPath(dom_path_pair)
+
+        targ_sfs = [np.linspace(ssf, esf, no_of_frames) for ssf, esf, no_of_frames in zip(inp_data[:,2], inp_data[:,3], no_frames_each)]
+        targ_sfs = np.concatenate(targ_sfs).ravel()
+        targ_frames = np.concatenate(targ_frames).ravel()
+        self.sf_spline = utils.ScaleFactorSpline(targ_sfs, targ_frames)
+
+    def sf_range(self, chunk_frames=4096):
+        '''The smallest and largest scale factor of the flight, found without making the frames'''
+        sf_min, sf_max = np.inf, -np.inf
+        for start in range(0, self.no_frames, chunk_frames):
+            sfs = self.sf_spline(np.arange(start, min(start + chunk_frames, self.no_frames), dtype="f8"))
+            sf_min, sf_max = min(sf_min, sfs.min()), max(sf_max, sfs.max())
+        return sf_min, sf_max
+
+    def iter_chunks(self, chunk_frames=4096):
+        '''Generates the rows of the flight file chunk_frames frames at a time
+        Yields:
+            flight [array]: Rows of frame, expansion factor, coordinates, x_basis, y_basis, z_basis'''
+        tangent = None
+        for start in range(0, self.no_frames, chunk_frames):
+            stop = min(start + chunk_frames, self.no_frames)
+            frames = np.arange(start, stop, dtype="f8")
+            with profiling.stage("scale_factors", len(frames)):
+                sfs = self.sf_spline(frames)
+            with profiling.stage("path_coords", len(frames)):
+                path_coords = self.path(frames)
+            with profiling.stage("look_at", len(frames)):
+                look_pos = gen_look_bundle(self.targ_data, self.no_frames, start, stop)
+                weights = look_pos[:,-1]
+                look_pos = look_pos[:,:-1]
+                basis_3 = look_at_vectors(path_coords, look_pos, weights)
+            with profiling.stage("tangents", len(frames)):
+                tangents = vector_derivs(frames, self.path, d_frame=2., previous=tangent)
+                tangent = tangents[-1]
+            with profiling.stage("orthonormalise", len(frames)):
+                basis_1 = orthonormalise(tangents, basis_3)
+                basis_2 = cross_basis(basis_3, basis_1)
+            yield np.c_[frames, sfs, path_coords, basis_1, basis_2, basis_3]
+
+def create_flight_path(inp_data, mult_h, fname, chunk_frames=4096, profile=None, progress=None, cancel=None,
+                       sim="RefL0025N0376"):
+    '''Creates a flight path from the data laid out in inp_data, and saves it as a txt under fname,
+    or in the binary flight format if fname ends in utils.FLIGHT_EXT. The frames are made and written
+    chunk_frames at a time
     All distances are in cMpc, all time in frames.
     Args:
         inp_data [array]: Numpy array with a specific layout, typically from the GUI data tables. I will
@@ -264,57 +416,51 @@ def create_flight_path(inp_data, mult_h, fname):
             hv: Helix veloicty, the velocity in the direction of the rotational axis. Used to make paths straight past
                 obects and helixes in units cMpc/frame
             ho: Initial axis height in units cMpc
+        mult_h [bool]: Multiply the distances in inp_data by h
+        fname [str]: The file to save the flight as
+        chunk_frames (optional) [int]: How many frames to make and write at a time
+        profile (optional) [str]: File to write the time, calls and sizes of every stage to, see profiling.
+            Defaults to the EFT_PROFILE environment variable, if neither is set nothing is timed
+        progress (optional) [function]: Called with the number of frames written and the number of frames
+            in the flight after every chunk
+        cancel (optional) [threading.Event]: Once set, no more chunks are made and the partly written
+            flight file is removed
+        sim (optional) [str]: The simulation the flight is through, saved in the flight file's header
+    Returns:
+        done [bool]: True once the flight file is written, False if it was cancelled
     '''
 
 
-    print "Generating flight-path"
-
-    #Gen old style target array
-    h= 0.6777
-    if mult_h:
-        inp_data[:,[4,5,6,10,12,14,15]] = inp_data[:,[4,5,6,10,12,14,15]] * h
-    targ_data = np.copy(inp_data[:, [0,1,4,5,6]])
-    targ_data[0,0] = targ_data[0,0] + 1
-    targ_data[-1, 1] = targ_data[-1,1] - 1
-
-
-    no_frames = int(inp_data[-1,1] - 1)
-    print "No of frames: %s" % no_frames
-
-    #Split input data into chunks
-    dom = inp_data[:,:2]
-    no_frames_each = dom[:,1] - dom[:,0] + 1
-    #Get frames for each galaxy target
-    targ_frames = [np.arange(no_of_frames) + start for no_of_frames, start in zip(no_frames_each, dom[:,0])]
-    #Specify the centre of each orbital path
-    centre_bundles = [gen_centre_bundle(frame_set, central_coord) for frame_set, central_coord in zip(targ_frames, inp_data[:,4:7])]
-    #gen the path functions for each sub path and match to their resp frame domains
-    path_functions = [OrbitalPath(centre_bundle, *args) for centre_bundle, args in zip(centre_bundles, inp_data[:, 7:])]
-    dom_path_pair = np.c_[dom, path_functions]
-    #Gen a combined, piecewise path for the motion
-    path = CombinedPath(dom_path_pair)
-
-    frames = np.arange(no_frames, dtype="f8")
-    look_pos = gen_look_bundle(targ_data,no_frames)
-    weights = look_pos[:,-1]
-    look_pos = look_pos[:,:-1]
-    #print look_pos, "\n----------\n", weights, "\n-----------\n"
-    targ_sfs = [np.linspace(ssf, esf, no_of_frames) for ssf, esf, no_of_frames in zip(inp_data[:,2], inp_data[:,3], no_frames_each)]
-    targ_sfs = np.concatenate(targ_sfs).ravel()
-    targ_frames = np.concatenate(targ_frames).ravel()
-    sfs = utils.get_scalefactors(targ_sfs, targ_frames, frames)
-
-    print "computing path coords -------"
-    path_coords = path(frames)
-
-    print "computing cam basis -------"
-    basis_3 = look_at_vectors(path_coords, look_pos, weights)
-    tangents = vector_derivs(frames, path, d_frame=2.)
-    basis_1 = orthonormalise(tangents, basis_3)
-    basis_2 = cross_basis(basis_3, basis_1)
-
-    utils.gen_flight_file(frames, sfs, path_coords, np.asarray([basis_1, basis_2,basis_3]), fname)
-    print "\nFlight file generated under path: %s" % fname
+    profiler = profiling.start(profile)
+    try:
+        print "Generating flight-path"
+        with profiling.stage("path_setup", len(inp_data)):
+            flight = FlightStream(inp_data, mult_h)
+        print "No of frames: %s" % flight.no_frames
+
+        def chunks():
+            written = 0
+            for rows in flight.iter_chunks(chunk_frames):
+                if cancel is not None and cancel.is_set():
+                    return
+                yield rows
+                written += len(rows)
+                if progress is not None:
+                    progress(written, flight.no_frames)
+
+        print "computing path coords and cam basis -------"
+        try:
+            utils.write_flight_chunks(fname, chunks(), flight.no_frames, sim)
+        except ValueError:
+            #a cancelled flight stops short of its frames, don't leave the part written behind
+            if cancel is None or not cancel.is_set():
+                raise
+            os.remove(fname)
+            print "\nFlight path generation cancelled"
+            return False
+        print "\nFlight file generated under path: %s" % fname
+    finally:
+        profiling.stop(profiler)
     return True
 
 
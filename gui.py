@@ -1,4 +1,6 @@
 from Tkinter import *
+import ttk
+import tkMessageBox
 import utils
 import matplotlib
 import matplotlib.pyplot as plt
@@ -10,6 +12,9 @@ from flightplan_generator import create_flight_path
 import copy
 import storyB_V2
 import os
+import Queue
+import threading
+import traceback
 from PIL import Image, ImageTk
 
 
@@ -51,6 +56,114 @@ class MainWindow(object):
         self.master.quit()
         self.master.destroy()
 
+class JobPanel(object):
+    '''A progress bar, status line and cancel button for running one long job at a time on a background
+    thread, so the window stays responsive. The job reports its progress, and its result or error, on a
+    queue that the Tk event loop polls, as Tk can only be used from the main thread'''
+    def __init__(self, master, poll_ms=100):
+        self.master = master
+        self.poll_ms = poll_ms
+        self.frame = Frame(self.master)
+        self.bar = ttk.Progressbar(self.frame, orient=HORIZONTAL, length=200, mode="determinate")
+        self.bar.grid(row=0, column=0)
+        self.status = StringVar(value="")
+        Label(self.frame, textvariable=self.status, width=36, anchor=W).grid(row=0, column=1)
+        self.cancel_b = Button(self.frame, text="Cancel", command=self.cancel, state=DISABLED)
+        self.cancel_b.grid(row=0, column=2)
+        self.events = Queue.Queue()
+        self.name = None
+        self.thread = None
+        self.cancel_event = None
+        self.closed = False
+
+    def busy(self):
+        return self.thread is not None
+
+    def start(self, name, job, on_done=None):
+        '''Runs job on a background thread
+        Args:
+            name [str]: What the job does, for the status line
+            job [function]: Takes a progress function, to be called with the frames done and the total
+                frames, and a threading.Event that is set to cancel the job
+            on_done (optional) [function]: Called on the Tk thread with what job returns, unless it fails
+        Returns:
+            started [bool]: False if a job is already running'''
+        if self.busy():
+            tkMessageBox.showinfo("Busy", "Wait for the %s to finish, or cancel it, first" % self.name)
+            return False
+        self.name = name
+        self.on_done = on_done
+        self.cancel_event = threading.Event()
+        self.bar["value"] = 0
+        self.status.set("%s: starting" % self.name)
+        self.cancel_b.config(state=NORMAL)
+        self.thread = threading.Thread(target=self.run, args=(job,))
+        #don't keep the app open after its windows are closed
+        self.thread.daemon = True
+        self.thread.start()
+        self.master.after(self.poll_ms, self.poll)
+        return True
+
+    def run(self, job):
+        try:
+            result = job(self.report, self.cancel_event)
+        except Exception:
+            self.events.put(("error", traceback.format_exc()))
+        else:
+            self.events.put(("done", result))
+
+    def report(self, done, total):
+        ''' The progress function given to the job, called on its thread '''
+        self.events.put(("progress", done, total))
+
+    def poll(self):
+        ''' Shows the latest progress of the job, and hands its result back once it finishes '''
+        if self.closed:
+            return
+        progress, finished = None, None
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event[0] == "progress":
+                    progress = event[1:]
+                else:
+                    finished = event
+        except Queue.Empty:
+            pass
+        if progress is not None:
+            done, total = progress
+            self.bar["maximum"] = max(total, 1)
+            self.bar["value"] = done
+            if not self.cancel_event.is_set():
+                self.status.set("%s: %i of %i frames" % (self.name, done, total))
+        if finished is None:
+            self.master.after(self.poll_ms, self.poll)
+            return
+
+        self.thread.join()
+        self.thread = None
+        self.cancel_b.config(state=DISABLED)
+        if finished[0] == "error":
+            self.status.set("%s failed" % self.name)
+            print finished[1]
+            tkMessageBox.showerror("Error", "The %s failed:\n%s" % (self.name, finished[1].strip().splitlines()[-1]))
+        else:
+            self.status.set("%s %s" % (self.name, "cancelled" if self.cancel_event.is_set() else "done"))
+            if self.on_done is not None:
+                self.on_done(finished[1])
+
+    def cancel(self):
+        ''' Asks the job to stop after the frame it is on '''
+        if self.busy():
+            self.cancel_event.set()
+            self.status.set("%s: cancelling after the current frame" % self.name)
+
+    def close(self):
+        ''' Cancels any job as its window closes, the job's result is then dropped '''
+        self.cancel()
+        self.closed = True
+
+
 class GraphWindow(object):
     '''Window for drawing graphs'''
     def __init__(self, master, fig):
@@ -61,6 +174,7 @@ class GraphWindow(object):
         Button(self.toolbar, text="Close Window", command=self.close_window).grid(row=0, column=0)
         Button(self.frame, text="Draw Graph", command=self.draw_graph).grid(row=3, column=0)
         Button(self.frame, text="Story Board", command=self.gen_story_board).grid(row=3, column=1)
+        Button(self.frame, text="Preview Frames", command=self.open_previews).grid(row=3, column=2)
         Label(self.frame, text="Flight File Name: ").grid(row=2,column=0)
         Label(self.frame, text="Simulation Code: ").grid(row=1, column=0)
         #Simulation code entry box
@@ -70,31 +184,101 @@ class GraphWindow(object):
         self.simname_e.insert(0, "RefL0025N0376")
         self.fname_e = Entry(master=self.frame, width=20)
         self.fname_e.grid(row=2, column=1)
+        #How many frames to draw the basis vectors of, the path line is always drawn in full
+        Label(self.frame, text="Basis Glyphs: ").grid(row=0, column=0)
+        self.glyphs_e = Entry(master=self.frame, width=20)
+        self.glyphs_e.grid(row=0, column=1)
+        self.glyphs_e.insert(0, "300")
+        #What the graph shown was drawn from, so it is only redrawn when that changes
+        self.graph_key = None
+        self.jobs = JobPanel(self.frame)
+        self.jobs.frame.grid(row=4, column=0, columnspan=3)
+        #Frame scrubber, set up once the previews of a flight are loaded
+        self.previewer = None
+        self.scrub_to = None
+        self.scrubber = Scale(self.frame, orient=HORIZONTAL, length=320, from_=0, to=0, label="Frame",
+                              command=self.scrub, state=DISABLED)
+        self.scrubber.grid(row=5, column=0, columnspan=3)
+        self.preview_l = Label(self.frame)
+        self.preview_l.grid(row=6, column=0, columnspan=3)
         self.toolbar.pack(side=TOP)
         self.frame.pack(side=LEFT)
         self.graph_f.pack(side=RIGHT)
         self.set_graph(fig, des=False)
 
     def close_window(self):
+        self.jobs.close()
+        if self.previewer is not None:
+            self.previewer.close()
         self.master.destroy()
 
+    def open_previews(self):
+        #Loads the merger trees for the flight in the background, then lets the scrubber preview its frames
+        sim_ref = self.simname_e.get()
+        fname = self.fname_e.get()
+        self.jobs.start("preview load", lambda progress, cancel: storyB_V2.FramePreviewer(fname, sim_ref),
+                        self.previews_ready)
+
+    def previews_ready(self, previewer):
+        if self.previewer is not None:
+            self.previewer.close()
+        self.previewer = previewer
+        self.scrubber.config(state=NORMAL, to=max(previewer.no_frames - 1, 0))
+        self.scrubber.set(0)
+        self.show_frame(0)
+
+    def scrub(self, value):
+        #The scale calls this for every step it's dragged over, only render the frame it's left on
+        #once Tk is idle, so dragging never queues up renders
+        if self.previewer is None:
+            return
+        if self.scrub_to is None:
+            self.master.after_idle(self.show_scrubbed)
+        self.scrub_to = int(float(value))
+
+    def show_scrubbed(self):
+        frame_no, self.scrub_to = self.scrub_to, None
+        self.show_frame(frame_no)
+
+    def show_frame(self, frame_no):
+        image = self.previewer.frame(frame_no)
+        photo = ImageTk.PhotoImage(Image.fromarray(np.ascontiguousarray(image[:, :, :3])))
+        self.preview_l.config(image=photo)
+        self.preview_l.image = photo
+
     def gen_story_board(self):
         #Find sim name, file name from entry boxes, then make folder to empty images into
         sim_ref = self.simname_e.get()
         fname = self.fname_e.get()
-        fname_root = fname[:-3]
+        fname_root = os.path.splitext(fname)[0]
         save_dir = os.path.join(fname_root, "images")
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
         image_name_base = os.path.join(save_dir, "image_no_")
-        storyB_V2.story_board(image_name_base, fname, sim_ref)
+        #rendered on a background thread, the job panel shows how far it has got
+        self.jobs.start("story board", lambda progress, cancel: storyB_V2.story_board(image_name_base, fname, sim_ref,
+                                                                                     progress=progress, cancel=cancel),
+                        self.story_board_done)
 
+    def story_board_done(self, failures):
+        if failures:
+            tkMessageBox.showwarning("Story Board", "%i frames could not be rendered, see the console" % len(failures))
 
     def draw_graph(self):
         #Plots the mpl figure from the flight path file, and sets it to the graph canvas
         fname = self.fname_e.get()
-        figure = utils.plot_from_file(fname)
+        glyphs = self.glyphs_e.get().strip()
+        max_glyphs = int(glyphs) if glyphs else None
+        stat = os.stat(fname)
+        graph_key = (os.path.abspath(fname), stat.st_mtime, stat.st_size, max_glyphs)
+        if graph_key == self.graph_key:
+            return
+        figure = utils.plot_from_file(fname, max_glyphs)
+        if self.graph_key is not None:
+            #pyplot keeps every figure until it is closed
+            plt.close(self.canvas.figure)
         self.set_graph(figure)
+        self.graph_key = graph_key
 
     def set_graph(self, fig, des=True):
         self.canvas = FigureCanvasTkAgg(fig, self.graph_f)
@@ -124,8 +308,10 @@ class DataWindow(object):
         lab_names = ["galaxy", "st fr", "en fr", "st sf", "en sf", "trg x", "y", "z", "rot ax: nx", "ny", "nz", "rv", "av", "ro", "ao", "hv", "ho"]
         for index, name in enumerate(lab_names):
             Label(self.data_f, text=name, width=4).grid(column=index, row=1)
+        self.jobs = JobPanel(self.master)
         self.frame.grid(row=0)
         self.data_f.grid(row=1)
+        self.jobs.frame.grid(row=2)
         self.draw_entry_boxes()
 
     def clear_entries(self):
@@ -144,8 +330,11 @@ class DataWindow(object):
     def gen_flight_plan(self):
         self.read_entry_boxes()
         fname = self.fname_e.get()
+        sim_ref = self.simname_e.get()
         inp_data = np.asarray(copy.deepcopy(self.data_store))
-        plan_file = create_flight_path(inp_data, True, fname)
+        self.jobs.start("flight file", lambda progress, cancel: create_flight_path(inp_data, True, fname,
+                                                                                  progress=progress, cancel=cancel,
+                                                                                  sim=sim_ref))
 
 
     def draw_entry_boxes(self):
@@ -175,6 +364,7 @@ class DataWindow(object):
 
 
     def close_window(self):
+        self.jobs.close()
         self.master.destroy()
 
 
@@ -0,0 +1,251 @@
+'''Optional timing of the stages of flight generation and story boarding.
+
+Stages are timed with profiling.stage, which does nothing unless a profile has been started, so the
+stages can be left in the code. A profile is started by create_flight_path and story_board when they
+are given a profile file name, or when the EFT_PROFILE environment variable is set to one. Eg:
+
+    EFT_PROFILE=storyboard_trace.json python gui.py
+
+When they finish, the wall time, calls and array sizes of every stage are printed as a table and
+written out as JSON. The file is in the Chrome trace event format, with a "stages" summary alongside
+the "traceEvents", so it can also be opened in chrome://tracing or https://ui.perfetto.dev to see
+each frame's stages on a timeline, worker processes included.
+'''
+import os
+import json
+import time
+import threading
+
+ENV_VAR = "EFT_PROFILE"
+
+
+class NullStage(object):
+    '''Stands in for a Stage when nothing is being profiled'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_size(self, size):
+        pass
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    '''Times the code run inside it as one call of a named stage of a Profiler'''
+    __slots__ = ("profiler", "name", "size", "start")
+
+    def __init__(self, profiler, name, size):
+        self.profiler = profiler
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.time() - self.start, self.size)
+        return False
+
+    def set_size(self, size):
+        '''Sets the number of items, eg galaxies or frames, the stage worked on, if it is only known inside'''
+        self.size = size
+
+
+class Profiler(object):
+    '''Adds up the time, calls and sizes of named stages, and keeps a trace event of each call'''
+    def __init__(self, trace_file=None, max_events=200000):
+        '''
+        Args:
+            trace_file (optional): Where save writes the profile to by default
+            max_events (optional): The most trace events to keep, past this only the stage totals
+                are added up, so profiling a very long flight doesn't fill the memory
+        '''
+        self.trace_file = trace_file
+        self.max_events = max_events
+        self.stats = {}
+        self.order = []
+        self.events = []
+        self.dropped_events = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def stage(self, name, size=None):
+        return Stage(self, name, size)
+
+    def record(self, name, start, seconds, size=None, pid=None, tid=None):
+        ''' Adds one call of the stage name, that started at the time start and took seconds '''
+        with self.lock:
+            if name not in self.stats:
+                self.order.append(name)
+                #calls, seconds, total size, largest size
+                self.stats[name] = [0, 0., 0, 0]
+            stats = self.stats[name]
+            stats[0] += 1
+            stats[1] += seconds
+            if size is not None:
+                stats[2] += size
+                stats[3] = max(stats[3], size)
+            if len(self.events) < self.max_events:
+                event = {"name": name, "ph": "X", "ts": start * 1e6, "dur": seconds * 1e6,
+                         "pid": pid if pid is not None else os.getpid(),
+                         "tid": tid if tid is not None else threading.current_thread().ident}
+                if size is not None:
+                    event["args"] = {"size": size}
+                self.events.append(event)
+            else:
+                self.dropped_events += 1
+
+    def records(self):
+        ''' The stages recorded so far in a form that can be sent between processes, for merge '''
+        with self.lock:
+            return {"order": list(self.order), "stats": dict((name, list(stats)) for name, stats in self.stats.items()),
+                    "events": list(self.events), "dropped_events": self.dropped_events}
+
+    def merge(self, records):
+        ''' Adds in the stages recorded by another Profiler, eg in a worker process '''
+        if records is None:
+            return
+        with self.lock:
+            for name in records["order"]:
+                calls, seconds, size, max_size = records["stats"][name]
+                if name not in self.stats:
+                    self.order.append(name)
+                    self.stats[name] = [0, 0., 0, 0]
+                stats = self.stats[name]
+                stats[0] += calls
+                stats[1] += seconds
+                stats[2] += size
+                stats[3] = max(stats[3], max_size)
+            room = max(self.max_events - len(self.events), 0)
+            self.events.extend(records["events"][:room])
+            self.dropped_events += records["dropped_events"] + max(len(records["events"]) - room, 0)
+
+    def summary(self):
+        ''' The stage totals as a table, stages run on worker processes add up the time of every worker '''
+        wall = time.time() - self.started
+        lines = ["%-22s %8s %11s %11s %7s %13s %11s" % ("stage", "calls", "total s", "mean ms", "% wall", "items", "max items")]
+        for name in self.order:
+            calls, seconds, size, max_size = self.stats[name]
+            lines.append("%-22s %8i %11.4f %11.4f %7.1f %13i %11i" % (name, calls, seconds, 1e3 * seconds / calls,
+                                                                      100. * seconds / wall if wall > 0 else 0.,
+                                                                      size, max_size))
+        lines.append("profiled for %.3f s wall" % wall)
+        if self.dropped_events:
+            lines.append("%i trace events past the first %i were not kept" % (self.dropped_events, self.max_events))
+        return "\n".join(lines)
+
+    def save(self, fname=None):
+        ''' Writes the stage totals and trace events as JSON in the Chrome trace event format '''
+        if fname is None:
+            fname = self.trace_file
+        wall = time.time() - self.started
+        with self.lock:
+            stages = [{"name": name, "calls": self.stats[name][0], "seconds": self.stats[name][1],
+                       "items": self.stats[name][2], "max_items": self.stats[name][3]} for name in self.order]
+            trace = {"traceEvents": self.events,
+                     "displayTimeUnit": "ms",
+                     "stages": stages,
+                     "wall_seconds": wall,
+                     "dropped_events": self.dropped_events}
+            with open(fname, "w") as pfile:
+                json.dump(trace, pfile)
+
+
+#the profile being recorded in this process, None when profiling is off
+_profiler = None
+
+
+def stage(name, size=None):
+    '''
+    Times a stage, as a context manager, if a profile is being recorded. Eg:
+
+        with profiling.stage("interpolation", len(frames)) as timed:
+            ...
+            timed.set_size(len(galaxies))
+    '''
+    if _profiler is None:
+        return NULL_STAGE
+    return _profiler.stage(name, size)
+
+
+def timed_iter(name, iterable, size_of=None):
+    '''
+    Yields the items of iterable, timing how long each takes to make as a call of the stage name
+    Args:
+        name: The stage name
+        iterable: Eg a generator that does the work of the stage as it is iterated over
+        size_of (optional): Function giving the number of items the stage worked on from each item yielded
+    '''
+    iterator = iter(iterable)
+    while True:
+        profiler = _profiler
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if profiler is not None:
+            profiler.record(name, start, time.time() - start, size_of(item) if size_of is not None else None)
+        yield item
+
+
+def enabled():
+    ''' True if a profile is being recorded in this process '''
+    return _profiler is not None
+
+
+def start(trace_file=None):
+    '''
+    Starts recording a profile, to be written to trace_file, or to the file named by the EFT_PROFILE
+    environment variable if trace_file is None
+    Returns:
+        The Profiler, to be passed to stop, or None if there is no file to profile to or a profile
+        is already being recorded, in which case the stages are added to that one
+    '''
+    global _profiler
+    if trace_file is None:
+        trace_file = os.environ.get(ENV_VAR) or None
+    if trace_file is None or _profiler is not None:
+        return None
+    _profiler = Profiler(trace_file)
+    return _profiler
+
+
+def stop(profiler):
+    ''' Stops recording the profile from start, writes it out and prints the summary '''
+    global _profiler
+    if profiler is None:
+        return
+    if _profiler is profiler:
+        _profiler = None
+    profiler.save()
+    print profiler.summary()
+    print "profile written to %s" % profiler.trace_file
+
+
+def merge(records):
+    ''' Adds the stages recorded by a worker process, from worker_records, to the profile being recorded '''
+    if _profiler is not None:
+        _profiler.merge(records)
+
+
+def worker_start(enable):
+    ''' Starts a fresh profile in a worker process if enable, eg if enabled() was True in the parent '''
+    global _profiler
+    _profiler = Profiler() if enable else None
+
+
+def worker_records():
+    ''' Stops the profile from worker_start and returns its records for merge, None if there wasn't one '''
+    global _profiler
+    if _profiler is None:
+        return None
+    records = _profiler.records()
+    _profiler = None
+    return records
@@ -0,0 +1,269 @@
+import os
+import struct
+import zlib
+import threading
+import traceback
+import Queue
+import numpy as np
+import matplotlib
+import profiling
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+from PIL import Image
+
+
+def png_name(fname):
+	''' Adds .png to a file name without an extension, the same as matplotlib's savefig does '''
+	if os.path.splitext(fname)[1] == "":
+		return fname + ".png"
+	return fname
+
+
+class MplRenderer(object):
+	'''
+	Draws story board frames as a matplotlib scatter. Slow, but gives figure quality output with axes
+	'''
+	def __init__(self):
+		#a figure of our own rather than pyplot's, so workers don't share any global figure state
+		self.fig = Figure()
+		FigureCanvasAgg(self.fig)
+
+	def plot(self, galaxies_to_plot):
+		''' Plots the galaxies from frame_view on the figure '''
+		self.fig.clf()
+		ax = self.fig.add_subplot(111)
+		#this is to catch any frames that are of zero lenght i.e. no galaxies in view
+		if len(galaxies_to_plot) >= 1:
+			#if you want to plot the images in behind the plot uncomment this line below
+			#img = imread("gas_%06i.png"%(i))
+			ax.scatter(galaxies_to_plot[:,0],galaxies_to_plot[:,1],marker='o', s=galaxies_to_plot[:,3], c='#7E317B',edgecolors='k')
+			ax.set_ylim( -1., 1.)
+			ax.set_xlim( - 1., 1.)
+			#if you want to plot the images in behind the plot uncomment this line below
+			#ax.imshow(img,extent=[-1.,1.,-1.,1.], aspect='auto')
+		else:
+			#img = imread("gas_%06i.png"%(i))
+			ax.scatter(0.0,0.0, s=0.0)
+			ax.set_ylim( -1., 1.)
+			ax.set_xlim( - 1., 1.)
+			#ax.imshow(img,extent=[-1.,1.,-1.,1.], aspect='auto')
+
+	def draw(self, galaxies_to_plot):
+		''' Returns the frame as an (height x width x 4) RGBA array '''
+		with profiling.stage("render", len(galaxies_to_plot)):
+			self.plot(galaxies_to_plot)
+			self.fig.canvas.draw()
+			width, height = self.fig.canvas.get_width_height()
+			return np.frombuffer(self.fig.canvas.buffer_rgba(), dtype=np.uint8).reshape(height, width, 4).copy()
+
+	def save(self, galaxies_to_plot, fname):
+		''' Saves the frame as a PNG '''
+		with profiling.stage("render", len(galaxies_to_plot)):
+			self.plot(galaxies_to_plot)
+		#savefig draws the figure as well as encoding it
+		with profiling.stage("save"):
+			self.fig.savefig(fname)
+
+
+class RasterRenderer(object):
+	'''
+	Draws story board frames straight in to a numpy RGBA buffer as filled, outlined discs and writes them
+	with PIL. Galaxies are drawn in the order given, so the furthest first ordering from frame_view and
+	the perspec sizes are kept, sizes being the marker area in points^2 as for the matplotlib scatter.
+	Much faster than matplotlib, for previewing long flights.
+	'''
+	def __init__(self, width=None, height=None, dpi=None, face='#7E317B', edge='k', line_width=1.):
+		'''
+		Args:
+			width, height: The image size in pixels, defaults to the size of a matplotlib figure
+			dpi: Dots per inch, used to turn marker sizes in points in to pixels
+			face, edge: The fill and outline colours of the discs
+			line_width: The width of the outline in pixels
+		'''
+		if dpi is None:
+			dpi = matplotlib.rcParams["figure.dpi"]
+		fig_w, fig_h = matplotlib.rcParams["figure.figsize"]
+		self.width = int(width if width is not None else round(fig_w * dpi))
+		self.height = int(height if height is not None else round(fig_h * dpi))
+		self.px_per_pt = dpi / 72.
+		self.face = np.array(to_rgba(face)) * 255
+		self.edge = np.array(to_rgba(edge)) * 255
+		self.line_width = line_width
+		#pixel centres, sliced for each disc rather than building a new grid every time
+		self.col_centres = np.arange(self.width) + 0.5
+		self.row_centres = np.arange(self.height) + 0.5
+
+	def draw(self, galaxies_to_plot):
+		''' Returns the frame as an (height x width x 4) RGBA array '''
+		with profiling.stage("render", len(galaxies_to_plot)):
+			image = np.empty((self.height, self.width, 4), dtype=np.uint8)
+			image[:] = 255
+			if len(galaxies_to_plot) == 0:
+				return image
+			#normalised coords to pixels, y runs down the image
+			cxs = (galaxies_to_plot[:,0] + 1.) * 0.5 * self.width
+			cys = (1. - galaxies_to_plot[:,1]) * 0.5 * self.height
+			radii = np.sqrt(np.maximum(galaxies_to_plot[:,3], 0.)) * 0.5 * self.px_per_pt
+			radii = np.minimum(radii, max(self.width, self.height))
+
+			#anything under a pixel across is only its outline, so set those pixels in one go
+			small = radii < 0.5
+			cols = np.clip(cxs[small].astype(int), 0, self.width - 1)
+			rows = np.clip(cys[small].astype(int), 0, self.height - 1)
+			image[rows, cols] = self.edge
+
+			for cx, cy, radius in zip(cxs[~small], cys[~small], radii[~small]):
+				x0, x1 = max(int(cx - radius), 0), min(int(cx + radius) + 1, self.width)
+				y0, y1 = max(int(cy - radius), 0), min(int(cy + radius) + 1, self.height)
+				if x0 >= x1 or y0 >= y1:
+					continue
+				dist2 = (self.col_centres[None, x0:x1] - cx)**2 + (self.row_centres[y0:y1, None] - cy)**2
+				patch = image[y0:y1, x0:x1]
+				patch[dist2 <= radius**2] = self.edge
+				patch[dist2 <= max(radius - self.line_width, 0.)**2] = self.face
+			return image
+
+	def save(self, galaxies_to_plot, fname):
+		''' Saves the frame as a PNG '''
+		#the frames are opaque, and encoding at the default compression takes longer than drawing
+		image = self.draw(galaxies_to_plot)[:, :, :3]
+		with profiling.stage("save"):
+			Image.fromarray(np.ascontiguousarray(image), "RGB").save(png_name(fname), compress_level=1)
+
+
+renderers = {"mpl": MplRenderer, "raster": RasterRenderer}
+
+
+def png_chunk(kind, data):
+	''' Packs data in to a PNG chunk of type kind, with its length and CRC '''
+	return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+class ApngStream(object):
+	'''
+	Writes an animated PNG one frame at a time, so only the frame being written is held in memory.
+	The frame count goes in the header before any frames, so if fewer are written it is patched on close.
+	'''
+	def __init__(self, afile, n_frames, fps):
+		self.afile = afile
+		self.n_frames = n_frames
+		self.fps = fps
+		self.sequence = 0
+		self.written = 0
+		self.actl_pos = None
+
+	def write_header(self, height, width):
+		self.afile.write("\x89PNG\r\n\x1a\n")
+		self.afile.write(png_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+		self.actl_pos = self.afile.tell()
+		self.afile.write(png_chunk("acTL", struct.pack(">II", self.n_frames, 0)))
+
+	def write(self, image):
+		''' Appends an (height x width x 3 or 4) uint8 image as the next frame '''
+		height, width = image.shape[:2]
+		if self.written == 0:
+			self.write_header(height, width)
+		self.afile.write(png_chunk("fcTL", struct.pack(">IIIIIHHBB", self.sequence, width, height, 0, 0, 1, self.fps, 0, 0)))
+		self.sequence += 1
+		#every scanline starts with its filter type, 0 for none
+		scanlines = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+		scanlines[:, 1:] = image[:, :, :3].reshape(height, width * 3)
+		data = zlib.compress(scanlines.tostring(), 1)
+		if self.written == 0:
+			self.afile.write(png_chunk("IDAT", data))
+		else:
+			self.afile.write(png_chunk("fdAT", struct.pack(">I", self.sequence) + data))
+			self.sequence += 1
+		self.written += 1
+
+	def close(self):
+		if self.written == 0:
+			return
+		self.afile.write(png_chunk("IEND", ""))
+		if self.written != self.n_frames:
+			self.afile.seek(self.actl_pos)
+			self.afile.write(png_chunk("acTL", struct.pack(">II", self.written, 0)))
+
+
+class AnimationWriter(object):
+	'''
+	Streams rendered frames straight in to one animation file on a background thread, so there are no
+	per frame PNGs and encoding overlaps rendering. Frames can be put in any order, eg as workers finish
+	them, and are written in frame order. A failed frame, put as None, repeats the frame before it.
+	Formats are "apng", an animated PNG, or "raw", the bare RGB bytes of each frame one after another,
+	for a named pipe in to a video encoder such as ffmpeg -f rawvideo.
+	'''
+	def __init__(self, fname, n_frames, fps=25, fmt=None, max_queued=32):
+		'''
+		Args:
+			fname: The file, or named pipe, to write to
+			n_frames: The number of frames that will be put, numbered 0 to n_frames-1
+			fps: Frames per second of the animation
+			fmt: "apng" or "raw", defaults to apng for .png and .apng files and raw for anything else
+			max_queued: How many frames can be waiting to be written before put blocks
+		'''
+		if fmt is None:
+			fmt = "apng" if os.path.splitext(fname)[1].lower() in (".png", ".apng") else "raw"
+		self.fname = fname
+		self.n_frames = n_frames
+		self.fps = fps
+		self.fmt = fmt
+		self.queue = Queue.Queue(max_queued)
+		self.error = None
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, frame_no, image):
+		''' Hands the image of frame frame_no to the writer, None if the frame failed '''
+		if self.error is not None:
+			raise IOError("animation writer failed:\n" + self.error)
+		self.queue.put((frame_no, image))
+
+	def close(self):
+		''' Waits for every frame to be written and closes the file '''
+		self.queue.put(None)
+		self.thread.join()
+		if self.error is not None:
+			raise IOError("animation writer failed:\n" + self.error)
+
+	def ordered_frames(self):
+		''' Yields the images in frame order as they arrive, holding back any that arrive early '''
+		pending = {}
+		next_no = 0
+		while True:
+			while next_no in pending:
+				yield pending.pop(next_no)
+				next_no += 1
+			item = self.queue.get()
+			if item is None:
+				break
+			pending[item[0]] = item[1]
+		for frame_no in sorted(pending):
+			yield pending[frame_no]
+
+	def run(self):
+		frames = self.ordered_frames()
+		try:
+			with open(self.fname, "wb") as afile:
+				stream = ApngStream(afile, self.n_frames, self.fps) if self.fmt == "apng" else None
+				last_image = None
+				for image in frames:
+					if image is None:
+						image = last_image
+					if image is None:
+						continue
+					with profiling.stage("encode"):
+						if stream is not None:
+							stream.write(image)
+						else:
+							afile.write(np.ascontiguousarray(image[:, :, :3]).tostring())
+					last_image = image
+				if stream is not None:
+					stream.close()
+		except Exception:
+			self.error = traceback.format_exc()
+			#keep taking frames so put never blocks for good
+			for image in frames:
+				pass
@@ -1,33 +1,65 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from DBS.dbgrabber import dbsPull
+from DBS.dbgrabber import dbsPullSnaps, dbsStoreKey, dbsCache
+from DBS.querycache import replace_file
 import matplotlib.pyplot as plt
-from utils import perspective_transfomation
-from utils import coord_transform
+import multiprocessing
+import collections
+import threading
+import traceback
+import tempfile
+import hashlib
+import json
+import os
+import re
 import utils
+import render
+import profiling
 from scipy.misc import imread
 
 h = 0.6777
 region = [15., 15., 15.]
+tree_columns = ["ID", "DesID", "SnapNum", "MassType_DM", "x", "y", "z", "Redshift"]
 
 Expansion_F_snaps = np.array([0.05, 0.06, 0.09, 0.10, 0.11, 0.12, 0.14, 0.15, 0.17,
                      0.18, 0.20, 0.22, 0.25, 0.29, 0.31, 0.33, 0.37, 0.40,
                      0.44, 0.50, 0.54, 0.58, 0.62, 0.67, 0.73, 0.79,0.85,
                      0.91, 1.00])
 
+#how far past the view of any frame to pull galaxies from when the query is restricted to the region a
+#flight looks at, in the units of x, y and z. This covers galaxies moving in to view between snapshots
+SQL_MARGIN = 3.
 
-def story_board(txt_name, path_file, sim):
+#the most frames to give a worker at once when rendering an animation, every frame of a task comes back
+#to the parent as an image, so this and the tasks pending bound the memory used however long the flight is
+ANIMATION_TASK_FRAMES = 8
 
-	''' This function produce a soryboard of all the frames specified on a flight path, 
-	saves as PNG files in the directory where the program is run
+#the last tree loaded by this process, kept so later tasks and story boards of the same query don't
+#read the memory mapped store again
+_trees = {}
 
-	Args:
 
-		 path file:A txt file of the flight path in the form frame, expansion factor, coordinates, x_basis, y_basis, z_basis
-		 txt_name:The name or relative file path of the txt file
+def storyboard_sql(sim, snap_range=None, bounds=None):
 
-	 '''
-	 #SQL to grab from the database 
+	''' The SQL to grab the merger trees of every z=0 halo above 1e10 from the database
+
+	Args:
+		sim: The simulation code, eg RefL0025N0376
+		snap_range (optional): The first and last snapshot to pull the progenitors of, defaults to all of them
+		bounds (optional): For each of x, y and z, a list of the (low, high) intervals to pull the progenitors
+			from, in the units of the x, y and z columns, or None to pull from the whole axis
+	Returns:
+		SQL: The query string
+	'''
+	#conditions on the progenitors, pushed in to the query so only the rows needed are sent
+	restrictions = ""
+	if snap_range is not None:
+		restrictions += " and\n\t\t\tPROG.SnapNum between %i and %i" % tuple(snap_range)
+	for axis, intervals in zip("xyz", bounds if bounds is not None else [None] * 3):
+		if intervals is not None:
+			#on the column itself rather than x, y or z so the database can use its index
+			restrictions += " and\n\t\t\t(%s)" % " or ".join("PROG.CentreOfPotential_%s between %0.5f and %0.5f"
+															 % (axis, low / h, high / h) for low, high in intervals)
 	SQL = """
 		SELECT
 			PROG.GalaxyID as ID,
@@ -46,87 +78,638 @@ def story_board(txt_name, path_file, sim):
 		WHERE
 			DES.SnapNum = 28 and
 			DES.MassType_DM > 1.0e10 and
-			PROG.GalaxyID between DES.GalaxyID and DES.LastProgID 
+			PROG.GalaxyID between DES.GalaxyID and DES.LastProgID%s
 
 		ORDER BY
 			PROG.GalaxyID,
 			PROG.SnapNum
-	""" % (h,h,h, sim, sim)
+	""" % (h,h,h, sim, sim, restrictions)
 
 	#        PROG.MassType_DM > 1.0e11 and
-	filename = "%s_DBS.p" % sim
-	boxsize = 25 * h
-	dbs_data = dbsPull(SQL, filename)
-
-	frame, ts, xs, ys, zs, b1,b2,b3,b4,b5,b6,b7,b8,b9 = np.loadtxt(path_file, unpack=True)
-	z_basis = np.transpose(np.asarray([b7, b8, b9]))
-	y_basis = np.transpose(np.asarray([b4, b5, b6]))
-	x_basis = np.transpose(np.asarray([b1, b2, b3]))
-	line_coords = np.transpose(np.asarray([xs, ys, zs]))
-
-
-
-	fig = plt.figure()
-	#to loop over every frame which will be plot on the story board
-	for i in range(len(frame)):
-		print "creating image: " + str(i)
-		#to find the new camera position, cam_pos, on the path
-		cam_position = [xs[i], ys[i], zs[i]]
-		x_bas = x_basis[i]
-		y_bas = y_basis[i]
-		z_bas = z_basis[i]
-		scale_factor = ts[i]
-
-		#wrap coordinates image data get center image manipulations preiodic wrap
-		centre = utils.get_centre([x_bas,y_bas,z_bas], cam_position, region)
-
-		#all the galaxies posistions at the scale factor of interest
-		All_galaxies = utils.gal_interpolation(scale_factor, dbs_data)
-		All_galaxies[:,[3,4,5]] = utils.periodic_wrap(All_galaxies[:,[3,4,5]], boxsize, centre)
-
-		#transforms into the camera view
-		galaxies_trans = coord_transform(x_bas, y_bas, z_bas, cam_position, All_galaxies[:,[3,4,5]])
-		galaxies_afterT = np.transpose(galaxies_trans)
-		galaxies_to_plot = perspective_transfomation(galaxies_trans, region)
-
-		#this is to catch any frames that are of zero lenght i.e. no galaxies in view 
-		if len(galaxies_to_plot) >= 1:
-
-			
-			#to find the mass and distances of the galaxies in order to scale size
-			indexList = np.asarray(galaxies_to_plot[:,4], dtype=int)
-			galaxZs = galaxies_afterT[indexList][:,2]
-			galaxYs = galaxies_afterT[indexList][:,1]
-			galaxXs = galaxies_afterT[indexList][:,0]
-			galZsMass = All_galaxies[indexList][:,2]
-			dist = (galaxZs**2 + galaxYs**2 + galaxXs**2)**0.5
-
-			#the relative sizes of the galaxies, change if you want to adjust
-			perspec = []
-			perspec = 1./dist**3
-			perspec *= (galZsMass)**0.43
-			perspec.shape = (1, len(perspec))
-
-
-			galaxies_to_plot = np.asarray(sorted(np.concatenate((galaxies_to_plot, perspec.T), axis=1), key=lambda coords: -coords[2]))
-			
-			#if you want to plot the images in behind the plot uncomment this line below 
-			#img = imread("gas_%06i.png"%(i))
-			plt.scatter(galaxies_to_plot[:,0],galaxies_to_plot[:,1],marker='o', s=galaxies_to_plot[:,5], c='#7E317B',edgecolors='k')
-			plt.ylim( 0, region[1])
-			plt.xlim( - region[0]/2., region[0]/2.)
-			plt.ylim( -1., 1.)
-			plt.xlim( - 1., 1.)
-			#if you want to plot the images in behind the plot uncomment this line below 
-			#plt.imshow(img,extent=[-1.,1.,-1.,1.], aspect='auto')
-			plt.savefig(txt_name + str(i))
-			plt.clf()
+	return SQL
+
+
+def load_tree(sim, snapnums, sql=None):
+
+	''' Loads the merger tree data for the given snapshots and indexes it for interpolation
+
+	Args:
+		sim: The simulation code
+		snapnums: The snapshot numbers the flight passes through, from utils.find_snapnum_range
+		sql (optional): The merger tree query, defaults to storyboard_sql(sim)
+	Returns:
+		tree: A utils.TreeIndex of the data
+	'''
+	if sql is None:
+		sql = storyboard_sql(sim)
+	#only load the snapshots the flight passes through, and the columns gal_interpolation uses
+	with profiling.stage("pull") as timed:
+		dbs_data = dbsPullSnaps(sql, sim, snapnums, tree_columns)
+		timed.set_size(len(dbs_data))
+	with profiling.stage("tree_index", len(dbs_data)):
+		return utils.TreeIndex(dbs_data)
+
+
+def cached_tree(sim, snapnums, sql=None):
+
+	''' Loads the merger tree data as load_tree does, reusing the last tree this process loaded
+	if it is from the same query and holds every snapshot asked for
+
+	Args:
+		sim: The simulation code
+		snapnums: The snapshot numbers the frames to render pass through
+		sql (optional): The merger tree query, defaults to storyboard_sql(sim)
+	Returns:
+		tree: A utils.TreeIndex of the data
+	'''
+	if sql is None:
+		sql = storyboard_sql(sim)
+	for (tree_sim, tree_sql, tree_snapnums), tree in _trees.items():
+		if tree_sim == sim and tree_sql == sql and set(snapnums) <= set(tree_snapnums):
+			return tree
+	_trees.clear()
+	tree = load_tree(sim, snapnums, sql)
+	_trees[(sim, sql, tuple(snapnums))] = tree
+	return tree
+
+
+def sim_boxsize(sim):
+
+	''' The size of the periodic box of a simulation, in the units of x, y and z, from the box length
+	in Mpc its code gives
+
+	Args:
+		sim: The simulation code, eg RefL0025N0376 for a 25 Mpc box
+	Returns:
+		boxsize: The size of the box
+	'''
+	match = re.search(r"L(\d{4})N\d{4}", sim)
+	if match is None:
+		raise ValueError("can't find the box size of the simulation %s" % sim)
+	return int(match.group(1)) * h
+
+
+def flight_bounds(path_file, boxsize, stream_frames=4096, margin=SQL_MARGIN):
+
+	''' The snapshots a flight passes through and the parts of the box its camera can see
+
+	Args:
+		path_file: The flight file, or a flightplan_generator.FlightStream
+		boxsize: The size of the periodic box
+		stream_frames (optional): How many frames of the flight to read at a time
+		margin (optional): How far past the view of any frame to take in, for the galaxies
+			moving in to view between snapshots
+	Returns:
+		snap_range: The first and last snapshot
+		bounds: For each of x, y and z, the (low, high) intervals the camera can see, or None for the
+			whole axis. None rather than a list if it can see the whole box
+	'''
+	no_frames, snapnums, chunks = flight_chunks(path_file, stream_frames)
+	if hasattr(path_file, "iter_chunks"):
+		#the frames of a FlightStream would have to be made twice to find where they look, so only
+		#the snapshots are restricted
+		return (snapnums[0], snapnums[-1]), None
+	#everything a frame can see is within the frustum radius of the centre of its view, see utils.get_centre.
+	#The centres are kept to a grid of cells so long flights don't need them all in memory
+	cell = margin / 4.
+	cells = [set(), set(), set()]
+	for start, rows in chunks:
+		centres = rows[:,2:5] + rows[:,11:14] * region[2] / 2.
+		for axis in range(3):
+			cells[axis].update(np.unique(np.floor(centres[:,axis] / cell)).astype(int))
+	half_width = utils.frustum_radius(region) + margin + cell
+	bounds = [utils.periodic_intervals((np.array(sorted(axis_cells)) + 0.5) * cell, half_width, boxsize)
+			  for axis_cells in cells]
+	if all(intervals is None for intervals in bounds):
+		bounds = None
+	return (snapnums[0], snapnums[-1]), bounds
+
+
+def flight_sql(sim, path_file, boxsize, stream_frames=4096, margin=SQL_MARGIN):
+
+	''' The merger tree query for one flight, restricted to the snapshots the flight passes through and
+	the parts of the box its camera can see, so only the rows it needs are pulled from the database
+
+	Args:
+		sim: The simulation code
+		path_file: The flight file, or a flightplan_generator.FlightStream
+		boxsize: The size of the periodic box, from sim_boxsize
+		stream_frames (optional): How many frames of the flight to read at a time
+		margin (optional): How far past the view of any frame to pull galaxies from, for the galaxies
+			moving in to view between snapshots
+	Returns:
+		SQL: The query string, from storyboard_sql
+	'''
+	snap_range, bounds = flight_bounds(path_file, boxsize, stream_frames, margin)
+	return storyboard_sql(sim, snap_range, bounds)
+
+
+def frame_view(flight_row, All_galaxies, positions, culler, boxsize):
+
+	''' Finds the galaxies the camera sees at one frame, and how big to draw them
+
+	Args:
+		flight_row: The row of the flight file for the frame, frame, expansion factor, coordinates, x_basis, y_basis, z_basis
+		All_galaxies: The galaxies of the frame's block from utils.batch_gal_interpolation
+		positions: The interpolated positions of those galaxies at the frame
+		culler: The utils.FrustumCuller of the block
+		boxsize: The size of the periodic box
+	Returns:
+		galaxies_to_plot: Array of the projected x, y, z and size of each galaxy in view, furthest first
+	'''
+	#to find the new camera position, cam_pos, on the path
+	cam_position = flight_row[2:5]
+	x_bas = flight_row[5:8]
+	y_bas = flight_row[8:11]
+	z_bas = flight_row[11:14]
+
+	#wrap coordinates image data get center image manipulations preiodic wrap
+	centre = utils.get_centre([x_bas,y_bas,z_bas], cam_position, region)
+
+	#the posistions at the scale factor of interest of the galaxies that may be in view
+	with profiling.stage("wrap") as timed:
+		candidates = culler.candidates(centre)
+		gal_coords = utils.periodic_wrap(positions[candidates], boxsize, centre)
+		timed.set_size(len(candidates))
+
+	#transforms into the camera view and clips to the galaxies in view
+	indexList, galaxies_to_plot, galaxies_in_cam = utils.project_galaxies(x_bas, y_bas, z_bas, cam_position, gal_coords, region)
+
+	with profiling.stage("depth_sort", len(indexList)):
+		#to find the mass and distances of the galaxies in order to scale size
+		galZsMass = All_galaxies[candidates[indexList], 2]
+		dist = np.sqrt(np.sum(galaxies_in_cam**2, axis=1))
+
+		#the relative sizes of the galaxies, change if you want to adjust
+		perspec = 1./dist**3
+		perspec *= (galZsMass)**0.43
+
+		#draw the furthest galaxies first
+		depth_order = np.argsort(-galaxies_to_plot[:,2], kind="mergesort")
+		return np.c_[galaxies_to_plot, perspec][depth_order]
+
+
+def render_frames(txt_name, image_nos, flight, tree, boxsize, renderer="mpl", on_frame=None, keep_images=False,
+				  cancel=None):
+
+	''' Renders a block of frames of a flight to PNG files, or to image arrays for an animation
+
+	Args:
+		txt_name: The name or relative file path to save the images under, the image number is appended
+		image_nos: The image number of each row of flight
+		flight: Array of rows of the flight file
+		tree: The utils.TreeIndex of the merger tree data
+		boxsize: The size of the periodic box
+		renderer (optional): The name of the renderer to draw with, from render.renderers
+		on_frame (optional): Called with the image number, traceback and image of every frame as soon as it is done
+		keep_images (optional): Return the frames as RGBA arrays rather than saving them as PNGs
+		cancel (optional): A threading.Event, once it is set no more frames are started
+	Returns:
+		results: List of (image number, traceback, image) for every frame, the traceback being None if the
+			frame was rendered and the image None unless keep_images is set and there is no on_frame
+			to hand it to. Short of the frames given if cancelled
+	'''
+	drawer = render.renderers[renderer]()
+	results = []
+	#interpolate the galaxies for blocks of frames between the same snapshots at once
+	blocks = utils.batch_gal_interpolation(flight[:,1], tree)
+	#the size of a block is its frames times its galaxies
+	for frame_indices, All_galaxies, positions in profiling.timed_iter("interpolation", blocks, lambda block: block[2].size // 3):
+		with profiling.stage("cull_index", positions.shape[1]):
+			culler = utils.FrustumCuller(positions, boxsize, region)
+		for j, i in enumerate(frame_indices):
+			if cancel is not None and cancel.is_set():
+				return results
+			print "creating image: " + str(image_nos[i])
+			try:
+				galaxies_to_plot = frame_view(flight[i], All_galaxies, positions[j], culler, boxsize)
+				if keep_images:
+					image = drawer.draw(galaxies_to_plot)
+				else:
+					image = None
+					drawer.save(galaxies_to_plot, txt_name + str(image_nos[i]))
+				error = None
+			except Exception:
+				image = None
+				error = traceback.format_exc()
+			if on_frame is not None:
+				on_frame(image_nos[i], error, image)
+				#on_frame has it, so a long block of frames doesn't keep every image
+				image = None
+			results.append((image_nos[i], error, image))
+	return results
+
+
+def render_task(task):
 
+	''' Worker process entry for render_frames, the merger trees are read from the memory mapped store
+
+	Args:
+		task: Tuple of txt_name, image_nos, flight, sim, sql, snapnums, boxsize, renderer, keep_images and profile,
+			sql being the merger tree query and profile being True to time the stages of the task
+	Returns:
+		results: As for render_frames, every frame of the task fails if the tree can't be loaded
+		records: The stages timed, for profiling.merge, None unless profile is set
+	'''
+	txt_name, image_nos, flight, sim, sql, snapnums, boxsize, renderer, keep_images, profile = task
+	profiling.worker_start(profile)
+	try:
+		results = render_frames(txt_name, image_nos, flight, cached_tree(sim, snapnums, sql), boxsize, renderer, keep_images=keep_images)
+	except Exception:
+		error = traceback.format_exc()
+		results = [(image_no, error, None) for image_no in image_nos]
+	return results, profiling.worker_records()
+
+
+def manifest_path(txt_name):
+
+	''' The manifest of a story board sits next to the directory its images are saved in,
+	eg flight/images_manifest.json for images saved as flight/images/image_no_N '''
+	images_dir = os.path.dirname(os.path.abspath(txt_name))
+	return images_dir + "_manifest.json"
+
+
+class RenderManifest(object):
+	'''
+	Records a hash of the inputs of every frame rendered in to an images directory, so a re-run of
+	the story board only renders the frames whose inputs have changed or whose image is missing.
+	It is saved as frames finish, so a story board that is killed part way through can be resumed.
+	'''
+	def __init__(self, path, save_every=50):
+		self.path = path
+		self.save_every = save_every
+		self.unsaved = 0
+		try:
+			with open(path, "r") as mfile:
+				self.frames = json.load(mfile)["frames"]
+		except (IOError, ValueError, KeyError):
+			self.frames = {}
+
+	def is_current(self, image_file, frame_hash):
+		''' True if image_file exists and was rendered from inputs with the hash frame_hash '''
+		return self.frames.get(os.path.basename(image_file)) == frame_hash and os.path.exists(image_file)
+
+	def record(self, image_file, frame_hash):
+		self.frames[os.path.basename(image_file)] = frame_hash
+		self.unsaved += 1
+		if self.unsaved >= self.save_every:
+			self.save()
+
+	def forget(self, image_file):
+		self.frames.pop(os.path.basename(image_file), None)
+
+	def save(self):
+		fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(self.path))
+		with os.fdopen(fd, "w") as mfile:
+			json.dump({"frames": self.frames}, mfile, indent=1, sort_keys=True)
+		replace_file(tmp_path, self.path)
+		self.unsaved = 0
+
+
+def frame_hash(flight_row, settings):
+
+	''' Hashes everything that goes in to rendering one frame
+
+	Args:
+		flight_row: The row of the flight file for the frame
+		settings: String of the inputs shared by every frame, the sim, data cache key and render settings
+	Returns:
+		The hex digest of the hash
+	'''
+	return hashlib.sha1(settings + np.asarray(flight_row, dtype="f8").tostring()).hexdigest()
+
+
+def flight_chunks(path_file, stream_frames):
+
+	''' Opens a flight to be rendered a chunk of frames at a time
+
+	Args:
+		path_file: A flight file, or a flightplan_generator.FlightStream to make the frames as they are needed
+		stream_frames: How many frames to a chunk
+	Returns:
+		no_frames: The number of frames in the flight
+		snapnums: The snapshot numbers the flight passes through
+		chunks: Iterator of the first frame number and rows of each chunk of the flight
+	'''
+	if hasattr(path_file, "iter_chunks"):
+		no_frames = path_file.no_frames
+		snapnums = utils.find_snapnum_range(path_file.sf_range(stream_frames))
+		rows_chunks = path_file.iter_chunks(stream_frames)
+	else:
+		#flight files are memory mapped where they can be, so only the chunk being rendered is read in
+		flight = utils.read_flight_file(path_file)[0]
+		no_frames = len(flight)
+		snapnums = utils.find_snapnum_range(flight[:,1])
+		rows_chunks = (np.asarray(flight[start:start+stream_frames]) for start in range(0, no_frames, stream_frames))
+
+	def chunks():
+		start = 0
+		for rows in profiling.timed_iter("flight", rows_chunks, len):
+			yield start, rows
+			start += len(rows)
+	return no_frames, snapnums, chunks()
+
+
+def story_board(txt_name, path_file, sim, processes=1, chunk_frames=None, renderer="mpl", resume=True,
+				animation=None, fps=25, stream_frames=4096, profile=None, snapnums=None, pool=None,
+				progress=None, cancel=None, pushdown=True):
+
+	''' This function produce a soryboard of all the frames specified on a flight path, 
+	saves as PNG files in the directory where the program is run
+
+	Args:
+
+		 path file:A txt or binary file of the flight path in the form frame, expansion factor, coordinates, x_basis, y_basis, z_basis,
+		 	or a flightplan_generator.FlightStream to render the frames as they are made
+		 txt_name:The name or relative file path of the txt file
+		 sim: The simulation code
+		 processes (optional): How many worker processes to render frames on, 1 renders them here.
+		 	With a pool, the number of workers it has
+		 chunk_frames (optional): How many consecutive frames to give a worker at once, defaults to
+		 	splitting the flight in to four chunks per worker. At most ANIMATION_TASK_FRAMES for an animation
+		 renderer (optional): "mpl" to draw with matplotlib for figure quality images, or "raster" to
+		 	draw straight in to an image buffer for fast previews
+		 resume (optional): Skip the frames the manifest next to the images directory says are
+		 	already rendered from the same inputs. False renders every frame
+		 animation (optional): File name to stream the frames in to as one animation rather than saving
+		 	a PNG per frame, an animated PNG for .png or .apng, or raw RGB frames for anything else,
+		 	eg a named pipe in to ffmpeg. Every frame is rendered and txt_name is not used
+		 fps (optional): Frames per second of the animation
+		 stream_frames (optional): How many frames of the flight to read or make at a time, which bounds
+		 	the memory used however long the flight is
+		 profile (optional): File to write the time, calls and sizes of every stage to, as JSON in the
+		 	Chrome trace format, see profiling. Defaults to the EFT_PROFILE environment variable,
+		 	if neither is set nothing is timed
+		 snapnums (optional): The snapshots to load, defaults to those the flight passes through. A wider
+		 	set lets the story boards of several flights of the same sim share one loaded tree
+		 pool (optional): A multiprocessing.Pool to render on rather than starting one, so the workers
+		 	and the trees they have loaded can be shared between story boards. It is left open
+		 progress (optional): Called with the number of frames done, rendered or found to be already
+		 	rendered, and the number of frames in the flight, every time that changes
+		 cancel (optional): A threading.Event, once it is set no more frames are started. Frames
+		 	already handed to worker processes are finished, and the manifest keeps every
+		 	finished frame, so a cancelled story board can be resumed
+		 pushdown (optional): Only pull the galaxies of the snapshots and parts of the box the flight
+		 	looks at from the database, see flight_sql. False pulls every galaxy of the sim, which
+		 	the story boards of several flights can share
+	Returns:
+		failures: Dict of image number to traceback for every frame that could not be rendered
+
+	 '''
+	boxsize = sim_boxsize(sim)
+
+	no_frames, flight_snapnums, chunks = flight_chunks(path_file, stream_frames)
+	if snapnums is None:
+		snapnums = flight_snapnums
+	sql = flight_sql(sim, path_file, boxsize, stream_frames) if pushdown else storyboard_sql(sim)
+
+	failures = []
+	if animation is not None:
+		#an animation is written as a whole, so there are no images on disk to resume from
+		writer = render.AnimationWriter(animation, no_frames, fps)
+		def frames_to_render(start, rows):
+			return np.arange(start, start + len(rows))
+		def finish_frame(image_no, error, image):
+			writer.put(image_no, image)
+			if error is not None:
+				failures.append((image_no, error))
+		finish = writer.close
+	else:
+		#only render the frames whose inputs have changed since they were last rendered
+		manifest = RenderManifest(manifest_path(txt_name))
+		#keyed on the query of the whole sim, not the pushed down one, which changes with any edit to where
+		#or when the flight goes. Every query gives the frames the same galaxies
+		settings = "%s\n%s\n%s\n%r\n%r\n" % (sim, dbsCache().key(storyboard_sql(sim), sim), renderer, region, boxsize)
+		#hashes of the frames being rendered, until they are recorded
+		hashes = {}
+		def frames_to_render(start, rows):
+			image_nos = []
+			with profiling.stage("resume_check", len(rows)):
+				for image_no, row in enumerate(rows, start):
+					row_hash = frame_hash(row, settings)
+					if not resume or not manifest.is_current(render.png_name(txt_name + str(image_no)), row_hash):
+						hashes[image_no] = row_hash
+						image_nos.append(image_no)
+			return np.array(image_nos, dtype=int)
+		def finish_frame(image_no, error, image):
+			image_file = render.png_name(txt_name + str(image_no))
+			row_hash = hashes.pop(image_no)
+			if error is None:
+				manifest.record(image_file, row_hash)
+			else:
+				manifest.forget(image_file)
+				failures.append((image_no, error))
+		finish = manifest.save
+	keep_images = animation is not None
+
+	def cancelled():
+		return cancel is not None and cancel.is_set()
+	#frames rendered, and frames done including those skipped as already rendered
+	counts = {"rendered": 0, "done": 0}
+	def frame_done(image_no, error, image):
+		finish_frame(image_no, error, image)
+		counts["rendered"] += 1
+		counts["done"] += 1
+		if progress is not None:
+			progress(counts["done"], no_frames)
+	def frames_skipped(skipped):
+		counts["done"] += skipped
+		if skipped and progress is not None:
+			progress(counts["done"], no_frames)
+
+	profiler = profiling.start(profile)
+	try:
+		if processes <= 1 and pool is None:
+			tree = None
+			for start, rows in chunks:
+				if cancelled():
+					break
+				image_nos = frames_to_render(start, rows)
+				frames_skipped(len(rows) - len(image_nos))
+				if len(image_nos) == 0:
+					continue
+				if tree is None:
+					tree = cached_tree(sim, snapnums, sql)
+				render_frames(txt_name, image_nos, rows[image_nos - start], tree, boxsize, renderer, frame_done, keep_images,
+							  cancel)
 		else:
-			#img = imread("gas_%06i.png"%(i))
-			plt.scatter(0.0,0.0, s=0.0)
-			plt.ylim( -1., 1.)
-			plt.xlim( - 1., 1.)
-			#plt.imshow(img,extent=[-1.,1.,-1.,1.], aspect='auto')
-			plt.savefig(txt_name + str(i))
-			plt.clf()
+			if chunk_frames is None:
+				chunk_frames = int(np.ceil(no_frames / (4. * processes)))
+			if keep_images:
+				chunk_frames = min(chunk_frames, ANIMATION_TASK_FRAMES)
+			chunk_frames = max(chunk_frames, 1)
+			own_pool = pool is None
+			if own_pool:
+				pool = multiprocessing.Pool(processes)
+			#tasks sent to the workers and not yet finished, kept to a few per worker so the
+			#chunks of the flight are only made as fast as they are rendered
+			pending = collections.deque()
+			def finish_task():
+				results, records = pending.popleft().get()
+				profiling.merge(records)
+				for image_no, error, image in results:
+					frame_done(image_no, error, image)
+			try:
+				pulled = False
+				for start, rows in chunks:
+					if cancelled():
+						break
+					image_nos = frames_to_render(start, rows)
+					frames_skipped(len(rows) - len(image_nos))
+					if len(image_nos) and not pulled:
+						pulled = True
+						#pull and split the data once here, the workers then all memory map the same store
+						with profiling.stage("pull"):
+							dbsStoreKey(sql, sim)
+					for task_start in range(0, len(image_nos), chunk_frames):
+						while len(pending) >= 2 * processes:
+							finish_task()
+						if cancelled():
+							break
+						task_nos = image_nos[task_start:task_start+chunk_frames]
+						task = (txt_name, task_nos, rows[task_nos - start], sim, sql, snapnums, boxsize, renderer, keep_images,
+								profiling.enabled())
+						pending.append(pool.apply_async(render_task, (task,)))
+				while pending:
+					finish_task()
+			finally:
+				if own_pool:
+					pool.close()
+					pool.join()
+	finally:
+		finish()
+		profiling.stop(profiler)
+
+	if cancelled():
+		print "cancelled, %i of %i frames rendered" % (counts["rendered"], no_frames)
+	else:
+		print "%i of %i frames rendered" % (counts["rendered"], no_frames)
+	for image_no, error in sorted(failures):
+		print "failed to create image: %s\n%s" % (image_no, error)
+	return dict(failures)
+
+
+class FramePreviewer(object):
+	'''
+	Renders single frames of a flight on demand at a low resolution, for scrubbing through it in the GUI.
+	The merger tree is loaded once, the frames rendered last are kept in an LRU cache, and a background
+	thread renders the frames either side of the one asked for last, so stepping through them is instant.
+	'''
+	def __init__(self, path_file, sim, width=320, height=240, cache_frames=64, prefetch=8, pushdown=True):
+		'''
+		Args:
+			path_file: The flight file
+			sim: The simulation code
+			width, height: The preview size in pixels, the galaxies are scaled down with it
+			cache_frames: How many previews to keep
+			prefetch: How many frames either side of the one asked for to render in the background
+			pushdown: Pull only what the flight looks at, as for story_board, so a story board of the
+				flight started after the previews reuses the same tree
+		'''
+		self.flight = utils.read_flight_file(path_file)[0]
+		self.no_frames = len(self.flight)
+		self.boxsize = sim_boxsize(sim)
+		sql = flight_sql(sim, path_file, self.boxsize) if pushdown else storyboard_sql(sim)
+		self.tree = cached_tree(sim, utils.find_snapnum_range(self.flight[:,1]), sql)
+		#the same view as a full size frame, so the marker sizes shrink with the image
+		self.drawer = render.RasterRenderer(width, height, dpi=width / float(plt.rcParams["figure.figsize"][0]))
+		self.cache_frames = cache_frames
+		self.prefetch = prefetch
+		#the frames of each block utils.batch_gal_interpolation would give render_frames share one culler
+		snap_pairs = utils.find_snapnum_pairs(self.flight[:,1])
+		run_bounds = np.r_[0, np.flatnonzero(np.any(snap_pairs[1:] != snap_pairs[:-1], axis=1)) + 1, self.no_frames]
+		self.block_starts = np.concatenate([np.arange(start, end, utils.BATCH_FRAMES) for start, end in zip(run_bounds[:-1], run_bounds[1:])])
+		self.block_ends = np.r_[self.block_starts[1:], self.no_frames]
+		self.cullers = collections.OrderedDict()
+		self.cache = collections.OrderedDict()
+		self.cache_lock = threading.Lock()
+		#the renderer and cullers are shared by the two threads, so only one frame is rendered at a time
+		self.render_lock = threading.Lock()
+		self.wanted = threading.Condition()
+		self.centre = None
+		self.closed = False
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def culler(self, frame_no):
+		''' The utils.FrustumCuller of the block of frames frame frame_no is in, kept for the last few
+		blocks. Must be called holding the render lock '''
+		block = np.searchsorted(self.block_starts, frame_no, side="right") - 1
+		if block in self.cullers:
+			self.cullers[block] = self.cullers.pop(block)
+		else:
+			#the galaxies' first and last positions in the block are all the culler needs to find the fast movers
+			ends = [self.block_starts[block], self.block_ends[block] - 1]
+			for frame_indices, All_galaxies, positions in utils.batch_gal_interpolation(self.flight[ends,1], self.tree):
+				self.cullers[block] = utils.FrustumCuller(positions, self.boxsize, region)
+			while len(self.cullers) > 4:
+				self.cullers.popitem(last=False)
+		return self.cullers[block]
+
+	def render(self, frame_no):
+		''' Renders the preview of frame frame_no, as an (height x width x 4) RGBA array '''
+		flight_row = np.asarray(self.flight[frame_no])
+		with self.render_lock:
+			culler = self.culler(frame_no)
+			for frame_indices, All_galaxies, positions in utils.batch_gal_interpolation(flight_row[1:2], self.tree):
+				return self.drawer.draw(frame_view(flight_row, All_galaxies, positions[0], culler, self.boxsize))
+
+	def cached(self, frame_no):
+		with self.cache_lock:
+			image = self.cache.pop(frame_no, None)
+			if image is not None:
+				self.cache[frame_no] = image
+			return image
+
+	def store(self, frame_no, image):
+		with self.cache_lock:
+			self.cache.pop(frame_no, None)
+			self.cache[frame_no] = image
+			while len(self.cache) > self.cache_frames:
+				self.cache.popitem(last=False)
+
+	def frame(self, frame_no):
+		''' Returns the preview of frame frame_no, and starts rendering the frames around it '''
+		image = self.cached(frame_no)
+		if image is None:
+			image = self.render(frame_no)
+			self.store(frame_no, image)
+		with self.wanted:
+			self.centre = frame_no
+			self.wanted.notify()
+		return image
+
+	def neighbours(self, centre):
+		''' The frames to prefetch around centre, nearest first and the next frame before the last '''
+		for step in range(1, self.prefetch + 1):
+			for frame_no in (centre + step, centre - step):
+				if 0 <= frame_no < self.no_frames:
+					yield frame_no
+
+	def run(self):
+		while True:
+			with self.wanted:
+				while self.centre is None and not self.closed:
+					self.wanted.wait()
+				if self.closed:
+					return
+				centre = self.centre
+				self.centre = None
+			for frame_no in self.neighbours(centre):
+				#a newer frame has been asked for, prefetch around that instead
+				if self.closed or self.centre is not None:
+					break
+				if self.cached(frame_no) is None:
+					try:
+						self.store(frame_no, self.render(frame_no))
+					except Exception:
+						#it will fail again, with its traceback, if it is asked for
+						pass
+
+	def close(self):
+		''' Stops the prefetching thread '''
+		with self.wanted:
+			self.closed = True
+			self.wanted.notify()
+		self.thread.join()
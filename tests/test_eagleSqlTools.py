@@ -0,0 +1,46 @@
+'''Checks the chunked CSV parser against the np.genfromtxt parsing it replaced.
+
+    python -m unittest discover -s tests -t .
+'''
+import unittest
+from StringIO import StringIO
+
+import numpy as np
+
+from DBS import eagleSqlTools
+
+
+class ParseRecordsTest(unittest.TestCase):
+
+    dtype = np.dtype([("GalaxyID", np.int64), ("SnapNum", np.int32), ("Mass", np.float32),
+                      ("x", np.float64), ("Name", eagleSqlTools.numpy_dtype["char"])])
+
+    def assertMatchesGenfromtxt(self, text):
+        expected = np.genfromtxt(StringIO(text), dtype=self.dtype, delimiter=",")
+        parsed = eagleSqlTools.parse_records(text, self.dtype)
+        self.assertEqual(parsed.dtype, self.dtype)
+        self.assertEqual(len(parsed), expected.size)
+        for name in self.dtype.names:
+            np.testing.assert_array_equal(parsed[name], np.atleast_1d(expected[name]))
+
+    def test_complete_rows(self):
+        self.assertMatchesGenfromtxt("1,28,1.5e10,10.25,a\n2,27,2e9,-3.5,bc\n")
+
+    def test_empty_fields(self):
+        self.assertMatchesGenfromtxt("1,,3.5,,a\n,27,,4.25,\n3,26,,,c\n")
+
+    def test_null_fields(self):
+        self.assertMatchesGenfromtxt("NULL,28,NULL,null,a\n2,NULL,1.5,2.5,NULL\n")
+
+    def test_chunked_rows(self):
+        text = "".join("%i,%s,%s,1.5,g%i\n" % (row, "" if row % 3 else row % 29, "" if row % 5 == 0 else row * 1e9, row)
+                       for row in range(1000))
+        batches = list(eagleSqlTools.iter_records(StringIO(text), self.dtype, chunk_size=97))
+        parsed = np.concatenate(batches)
+        expected = np.genfromtxt(StringIO(text), dtype=self.dtype, delimiter=",")
+        for name in self.dtype.names:
+            np.testing.assert_array_equal(parsed[name], expected[name])
+
+
+if __name__ == "__main__":
+    unittest.main()
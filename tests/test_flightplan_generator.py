@@ -0,0 +1,72 @@
+'''Checks CombinedPath picks the same path function at every frame as the per domain np.piecewise it replaced.
+
+    python -m unittest discover -s tests -t .
+'''
+import unittest
+
+import numpy as np
+
+import flightplan_generator as fpg
+
+
+def orbital_path(start, end, centre, args):
+    frames = np.arange(start, end + 1)
+    return fpg.OrbitalPath(fpg.gen_centre_bundle(frames, centre), *args)
+
+
+def piecewise_reference(func_domain, frames, deriv=False):
+    '''Each frame from the last domain [dom_s, dom_e) holding it, 0 outside every domain, as np.piecewise did'''
+    out = np.zeros((len(frames), 3))
+    for dom_s, dom_e, func in func_domain:
+        mask = (frames >= dom_s) * (frames < dom_e)
+        if mask.any():
+            out[mask] = func.deriv(frames[mask]) if deriv else func(frames[mask])
+    return out
+
+
+class CombinedPathTest(unittest.TestCase):
+
+    def setUp(self):
+        #domains that abut, leave a gap for a spline, and overlap
+        domains = [(0, 40), (40, 80), (100, 150), (140, 200)]
+        centres = [(1., 2., 3.), (10., 2., 3.), (10., 12., 3.), (20., 12., 8.)]
+        args = [(0., 0., 1., 0., 0.01, 2., 0., 0., 0.),
+                (0., 1., 0., 0.02, 0.02, 1., 0.25, 0.05, 0.),
+                (1., 0., 0., -0.01, 0.005, 3., 0.5, 0., 1.),
+                (1., 1., 1., 0., 0.03, 1.5, 0., 0.02, -1.)]
+        functions = [orbital_path(dom_s, dom_e, centre, arg)
+                     for (dom_s, dom_e), centre, arg in zip(domains, centres, args)]
+        self.path = fpg.CombinedPath(np.c_[np.asarray(domains, dtype="f8"), functions])
+
+    def join_frames(self):
+        '''The frames at and either side of every domain start and end'''
+        edges = np.asarray(self.path.func_domain[:, :2], dtype="f8").ravel()
+        return np.unique(np.concatenate([edges + offset for offset in (-1., -1e-6, 0., 1e-6, 0.5, 1.)]))
+
+    def test_gap_filled_with_spline(self):
+        self.assertEqual(len(self.path.func_domain), 5)
+        dom_s, dom_e, func = self.path.func_domain[-1]
+        self.assertEqual((dom_s, dom_e), (79, 101))
+        self.assertIsInstance(func, fpg.SplinePath)
+
+    def test_joins_match_piecewise(self):
+        frames = self.join_frames()
+        np.testing.assert_array_equal(self.path(frames), piecewise_reference(self.path.func_domain, frames))
+
+    def test_joins_match_piecewise_deriv(self):
+        frames = self.join_frames()
+        np.testing.assert_array_equal(self.path.deriv(frames),
+                                      piecewise_reference(self.path.func_domain, frames, deriv=True))
+
+    def test_every_frame_matches_piecewise(self):
+        frames = np.arange(-5, 210, dtype="f8")
+        np.testing.assert_array_equal(self.path(frames), piecewise_reference(self.path.func_domain, frames))
+        #unsorted frames, as a single frame at a time
+        shuffled = np.random.RandomState(0).permutation(frames)
+        np.testing.assert_array_equal(self.path(shuffled), piecewise_reference(self.path.func_domain, shuffled))
+        for frame in (0., 40., 99.5, 145., 200.):
+            np.testing.assert_array_equal(self.path(frame), piecewise_reference(self.path.func_domain, np.array([frame])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+'''Checks the lock the records cache and tree store are changed under.
+
+    python -m unittest discover -s tests -t .
+'''
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from DBS.querycache import FileLock
+
+
+class FileLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_threads_share_one_lock(self):
+        lock = FileLock(os.path.join(self.tmp_dir, "index.lock"))
+        inside = []
+        overlaps = []
+        errors = []
+
+        def hold(times):
+            try:
+                for attempt in range(times):
+                    with lock:
+                        inside.append(threading.current_thread().name)
+                        if len(inside) > 1:
+                            overlaps.append(list(inside))
+                        time.sleep(0.001)
+                        inside.remove(threading.current_thread().name)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=hold, args=(50,)) for index in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(overlaps, [])
+
+    def test_released_after_an_error(self):
+        lock = FileLock(os.path.join(self.tmp_dir, "index.lock"))
+        try:
+            with lock:
+                raise KeyError("inside")
+        except KeyError:
+            pass
+        done = []
+        thread = threading.Thread(target=lambda: done.append(lock.__enter__() and lock.__exit__(None, None, None)))
+        thread.start()
+        thread.join(5)
+        self.assertEqual(done, [False])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+'''Checks that the query pushed down for a flight keeps every galaxy the flight's frames show.
+
+    python -m unittest discover -s tests -t .
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import utils
+import storyB_V2
+from DBS.synthetic import synthetic_trees
+
+
+def frames_in_view(flight, dbs_data, boxsize):
+    '''The galaxies_to_plot of every frame of flight, as storyB_V2.render_frames finds them'''
+    tree = utils.TreeIndex(dbs_data)
+    views = []
+    for frame_indices, All_galaxies, positions in utils.batch_gal_interpolation(flight[:, 1], tree):
+        culler = utils.FrustumCuller(positions, boxsize, storyB_V2.region)
+        for j, i in enumerate(frame_indices):
+            views.append(storyB_V2.frame_view(flight[i], All_galaxies, positions[j], culler, boxsize))
+    return views
+
+
+class FlightSqlTest(unittest.TestCase):
+
+    sim = "RefL0100N1504"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.boxsize = storyB_V2.sim_boxsize(self.sim)
+        self.dbs_data = synthetic_trees(4000, self.boxsize, seed=1)
+        #a camera looking along x as it moves across part of the box, wrapping round its far edge
+        no_frames = 60
+        cam_positions = np.c_[np.linspace(self.boxsize - 10., self.boxsize + 5., no_frames),
+                              np.full(no_frames, 20.), np.full(no_frames, 30.)]
+        basis = np.tile([0., 1., 0., 0., 0., 1., 1., 0., 0.], (no_frames, 1))
+        self.flight = np.c_[np.arange(no_frames), np.linspace(0.5, 0.62, no_frames), cam_positions, basis]
+        self.flight_file = os.path.join(self.tmp_dir, "flight" + utils.FLIGHT_EXT)
+        utils.write_flight_file(self.flight_file, self.flight, self.sim)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sim_boxsize(self):
+        self.assertAlmostEqual(storyB_V2.sim_boxsize("RefL0025N0376"), 25 * storyB_V2.h)
+        self.assertAlmostEqual(storyB_V2.sim_boxsize("RefL0100N1504"), 100 * storyB_V2.h)
+        self.assertRaises(ValueError, storyB_V2.sim_boxsize, "Synthetic")
+
+    def test_region_clause(self):
+        sql = storyB_V2.flight_sql(self.sim, self.flight_file, self.boxsize)
+        self.assertIn("PROG.SnapNum between 19 and 23", sql)
+        for axis in "xyz":
+            self.assertIn("PROG.CentreOfPotential_%s between" % axis, sql)
+
+    def test_pushed_down_rows_hold_every_galaxy_in_view(self):
+        snap_range, bounds = storyB_V2.flight_bounds(self.flight_file, self.boxsize)
+        #the rows the pushed down query returns
+        keep = (self.dbs_data["SnapNum"] >= snap_range[0]) & (self.dbs_data["SnapNum"] <= snap_range[1])
+        full = self.dbs_data[keep]
+        for axis, intervals in zip("xyz", bounds):
+            if intervals is not None:
+                keep &= np.any([(self.dbs_data[axis] >= low) & (self.dbs_data[axis] <= high)
+                                for low, high in intervals], axis=0)
+        pushed = self.dbs_data[keep]
+        self.assertLess(len(pushed), len(full) / 4)
+
+        full_views = frames_in_view(self.flight, full, self.boxsize)
+        pushed_views = frames_in_view(self.flight, pushed, self.boxsize)
+        self.assertGreater(sum(len(view) for view in full_views), 0)
+        for frame, (full_view, pushed_view) in enumerate(zip(full_views, pushed_views)):
+            np.testing.assert_array_equal(pushed_view, full_view, "frame %i" % frame)
+
+
+if __name__ == "__main__":
+    unittest.main()
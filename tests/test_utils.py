@@ -0,0 +1,117 @@
+'''Round trips flights through the text and binary flight file formats.
+
+    python -m unittest discover -s tests -t .
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+import utils
+
+
+class FlightFormatTest(unittest.TestCase):
+
+    sim = "RefL0025N0376"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rand = np.random.RandomState(2)
+        no_frames = 50
+        self.flight = np.c_[np.arange(no_frames), np.linspace(0.1, 1., no_frames),
+                            rand.uniform(0., 25., (no_frames, 3)), rand.uniform(-1., 1., (no_frames, 9))]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def chunks(self):
+        return [self.flight[start:start + 16] for start in range(0, len(self.flight), 16)]
+
+    def test_binary_round_trip(self):
+        fname = self.path("flight" + utils.FLIGHT_EXT)
+        utils.write_flight_file(fname, self.flight, self.sim)
+        self.assertTrue(utils.is_binary_flight(fname))
+        for mmap_mode in ("r", None):
+            flight, sim = utils.read_flight_file(fname, mmap_mode=mmap_mode)
+            self.assertEqual(sim, self.sim)
+            self.assertEqual(flight.shape, (len(self.flight), 14))
+            np.testing.assert_array_equal(flight, self.flight)
+        self.assertIsInstance(utils.read_flight_file(fname)[0].base, np.memmap)
+        self.assertNotIsInstance(utils.read_flight_file(fname, mmap_mode=None)[0].base, np.memmap)
+
+    def test_binary_records(self):
+        fname = self.path("flight" + utils.FLIGHT_EXT)
+        utils.write_flight_file(fname, self.flight, self.sim)
+        records, sim = utils.read_flight_file(fname, records=True)
+        self.assertEqual(records.dtype, utils.FLIGHT_DTYPE)
+        np.testing.assert_array_equal(records["frame"], self.flight[:, 0])
+        np.testing.assert_array_equal(records["sf"], self.flight[:, 1])
+        np.testing.assert_array_equal(records["position"], self.flight[:, 2:5])
+
+    def test_text_round_trip(self):
+        fname = self.path("flight.txt")
+        utils.write_flight_file(fname, self.flight, self.sim)
+        self.assertFalse(utils.is_binary_flight(fname))
+        flight, sim = utils.read_flight_file(fname)
+        self.assertEqual(sim, self.sim)
+        #frames are written as integers and the rest to 5 decimal places
+        np.testing.assert_allclose(flight, self.flight, rtol=0, atol=5e-6)
+        records = utils.read_flight_file(fname, records=True)[0]
+        np.testing.assert_array_equal(records["frame"], self.flight[:, 0])
+
+    def test_chunks_match_whole(self):
+        for ext in (utils.FLIGHT_EXT, ".txt"):
+            whole, chunked = self.path("whole" + ext), self.path("chunked" + ext)
+            utils.write_flight_file(whole, self.flight, self.sim)
+            utils.write_flight_chunks(chunked, iter(self.chunks()), len(self.flight), self.sim)
+            with open(whole, "rb") as wfile, open(chunked, "rb") as cfile:
+                self.assertEqual(wfile.read(), cfile.read())
+            self.assertRaises(ValueError, utils.write_flight_chunks, chunked, self.chunks(),
+                              len(self.flight) + 1, self.sim)
+
+    def test_empty_flight(self):
+        for ext in (utils.FLIGHT_EXT, ".txt"):
+            fname = self.path("empty" + ext)
+            utils.write_flight_chunks(fname, [], 0, self.sim)
+            with warnings.catch_warnings():
+                #loadtxt warns the text file has no rows
+                warnings.simplefilter("ignore")
+                flight, sim = utils.read_flight_file(fname)
+            self.assertEqual(flight.shape, (0, 14))
+            self.assertEqual(sim, self.sim)
+
+    def test_convert_old_text(self):
+        #a flight written as gen_flight_file wrote them before the binary format
+        old = self.path("old.txt")
+        np.savetxt(old, self.flight, fmt=utils.FLIGHT_TEXT_FMT, header=self.sim)
+        expected = np.loadtxt(old)
+        binary = self.path("old" + utils.FLIGHT_EXT)
+        utils.convert_flight_file(old, binary)
+        self.assertTrue(utils.is_binary_flight(binary))
+        flight, sim = utils.read_flight_file(binary)
+        self.assertEqual(sim, self.sim)
+        np.testing.assert_array_equal(flight, expected)
+        #and back to text, the same as the original
+        text = self.path("back.txt")
+        utils.convert_flight_file(binary, text)
+        with open(old, "rb") as ofile, open(text, "rb") as tfile:
+            self.assertEqual(ofile.read(), tfile.read())
+
+    def test_convert_headerless_text(self):
+        old = self.path("old.txt")
+        np.savetxt(old, self.flight, fmt=utils.FLIGHT_TEXT_FMT)
+        binary = self.path("old" + utils.FLIGHT_EXT)
+        utils.convert_flight_file(old, binary)
+        flight, sim = utils.read_flight_file(binary)
+        self.assertEqual(sim, "")
+        np.testing.assert_array_equal(flight, np.loadtxt(old))
+
+
+if __name__ == "__main__":
+    unittest.main()
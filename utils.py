@@ -1,9 +1,14 @@
 import matplotlib.pyplot as plt
 import numpy as np
+import os
+import struct
+import threading
+import profiling
 from DBS.dbgrabber import dbsPull
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from numpy import pi
+from collections import OrderedDict
 from scipy.interpolate import UnivariateSpline, interp1d, spline
 
 Expansion_F_snaps = np.array([0.05, 0.06, 0.09, 0.10, 0.11, 0.12, 0.14, 0.15, 0.17,
@@ -11,18 +16,37 @@ Expansion_F_snaps = np.array([0.05, 0.06, 0.09, 0.10, 0.11, 0.12, 0.14, 0.15, 0.
 					 0.44, 0.50, 0.54, 0.58, 0.62, 0.67, 0.73, 0.79,0.85,
 					 0.91, 1.00])
 
-def plot_from_file(f_name):
+#binary flight files start with a fixed size header of the magic string, format version, bytes per frame,
+#number of frames and sim name. The frames follow as records of 14 little endian doubles, in the same order as
+#the columns of the text format, so the file maps straight on to the (frames x 14) array loadtxt gives
+FLIGHT_MAGIC = "EFTFLGHT"
+FLIGHT_VERSION = 1
+FLIGHT_HEADER = struct.Struct("<8sIIQ40s")
+FLIGHT_EXT = ".flight"
+FLIGHT_DTYPE = np.dtype([("frame", "<f8"), ("sf", "<f8"), ("position", "<f8", 3),
+						 ("x_basis", "<f8", 3), ("y_basis", "<f8", 3), ("z_basis", "<f8", 3)])
+FLIGHT_TEXT_FMT = "%i %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f"
+
+#flights kept by read_flight_cached, by path, with the modification time and size they were read at
+FLIGHT_CACHE_SIZE = 4
+_flight_cache = OrderedDict()
+
+def plot_from_file(f_name, max_glyphs=300):
 
 	'''
 	A funcion to produce a 3D matplotlib plot of a flightpath, includes the basis vectors where blue is the look direction
 
 	Args:
-		f_name: A txt file of the flight path in the format frame, expansion factor, coordinates, x_basis, y_basis, z_basis
+		f_name: A txt or binary file of the flight path in the format frame, expansion factor, coordinates, x_basis, y_basis, z_basis
+		max_glyphs: optional, the most frames to draw the points and basis vectors of, spread evenly along the flight.
+					The path line always has every frame. None draws them all, which is slow to draw and rotate
+					for long flights
 
 	Returns:
 		fig: The figure of the matplotlib plot
 	'''
-	fs,sfs,xs,ys,zs,v1xs,v1ys,v1zs,v2xs,v2ys,v2zs,v3xs,v3ys,v3zs = np.loadtxt(f_name, unpack=True)
+	flight = read_flight_cached(f_name)
+	fs,sfs,xs,ys,zs,v1xs,v1ys,v1zs,v2xs,v2ys,v2zs,v3xs,v3ys,v3zs = flight.T
 	#Plotting bits
 	fig = plt.figure()
 	ax = fig.add_subplot(111, projection="3d")
@@ -34,6 +58,10 @@ def plot_from_file(f_name):
 	basis_2 = np.asarray([v2xs,v2ys,v2zs]).T
 	basis_3 = np.asarray([v3xs,v3ys,v3zs]).T
 	ax.plot(path_coords[:, 0], path_coords[:, 1], path_coords[:, 2])
+	if max_glyphs is not None and len(flight) > max_glyphs:
+		#the first and last frames are always drawn
+		glyphs = np.unique(np.linspace(0, len(flight) - 1, max(max_glyphs, 2)).astype(int))
+		path_coords, basis_1, basis_2, basis_3 = path_coords[glyphs], basis_1[glyphs], basis_2[glyphs], basis_3[glyphs]
 	ax.scatter(path_coords[:, 0], path_coords[:, 1], path_coords[:, 2])
 	ax.quiver(path_coords[:, 0], path_coords[:, 1], path_coords[:, 2],
 				basis_1[:, 0], basis_1[:, 1], basis_1[:, 2], pivot="tail", color="#FF0000")
@@ -56,15 +84,7 @@ def get_scalefactors(targ_sfs, targ_frames, frames):
 		
 	Returns:
 		sfs: The list of scale factors for the frames given'''
-	#Make them smooth in log10
-	log_targ_sfs = np.log10(targ_sfs)
-	lsf_spline = UnivariateSpline(targ_frames, log_targ_sfs, s=0)
-	lsfs = lsf_spline(frames)
-	#Bring them out of log10
-	sfs = np.power(10,lsfs)
-	#Keep them within bounds
-	sfs[np.where(sfs > 1)] = 1
-	sfs[np.where(sfs < 0)] = 0
+	sfs = ScaleFactorSpline(targ_sfs, targ_frames)(frames)
 	# Plot the sf graph to confirm
 	# fig = plt.figure()
 	# ax = fig.add_subplot(111)
@@ -73,10 +93,28 @@ def get_scalefactors(targ_sfs, targ_frames, frames):
 	# plt.show()
 	return sfs
 
-def gen_flight_file(frames, sfs, coords, basis_vects, fname, head="RefL0025N0376"):
+class ScaleFactorSpline(object):
+	'''
+	The spline get_scalefactors fits, kept so the scale factors of a long flight can be found a chunk of frames at a time
+	'''
+	def __init__(self, targ_sfs, targ_frames):
+		#Make them smooth in log10
+		log_targ_sfs = np.log10(targ_sfs)
+		self.lsf_spline = UnivariateSpline(targ_frames, log_targ_sfs, s=0)
+
+	def __call__(self, frames):
+		lsfs = self.lsf_spline(frames)
+		#Bring them out of log10
+		sfs = np.power(10,lsfs)
+		#Keep them within bounds
+		sfs[np.where(sfs > 1)] = 1
+		sfs[np.where(sfs < 0)] = 0
+		return sfs
+
+def gen_flight_file(frames, sfs, coords, basis_vects, fname, head="RefL0025N0376", binary=None):
 
 	'''
-	Saves the flight path generated as a txt file
+	Saves the flight path generated as a txt file, or a binary one
 
 	Args:
 		frames: the frame number at each instance
@@ -86,6 +124,8 @@ def gen_flight_file(frames, sfs, coords, basis_vects, fname, head="RefL0025N0376
 		fname: the name to save the txt file of the flight path as
 		head: optional, changes the header for the simulation box you are working in. Default is the
 			  25 mpc box, RefL0025N0376
+		binary: optional, save in the binary flight format at full precision rather than as text. Default is
+			  binary for file names ending in FLIGHT_EXT
 	Returns:
 		A txt file with the name of fname with columns of the arguments in the same order.
 	'''
@@ -94,7 +134,138 @@ def gen_flight_file(frames, sfs, coords, basis_vects, fname, head="RefL0025N0376
 										basis_vects[1,:,0], basis_vects[1,:,1], basis_vects[1,:,2],
 										basis_vects[2,:,0], basis_vects[2,:,1], basis_vects[2,:,2]])
 	#print setspace
-	np.savetxt(fname, setspace.T, fmt="%i %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f %0.5f", header=head )
+	write_flight_file(fname, setspace.T, head, binary)
+
+
+def write_flight_file(fname, flight, sim, binary=None):
+
+	'''
+	Saves the rows of a flight, as text or in the binary flight format
+	Args:
+		fname: the name to save the flight as
+		flight: the (frames x 14) array of frame, expansion factor, coordinates, x_basis, y_basis, z_basis
+		sim: the simulation code, saved in the header
+		binary: optional, save in the binary format. Default is binary for file names ending in FLIGHT_EXT
+	'''
+	flight = np.asarray(flight, dtype="<f8").reshape(-1, 14)
+	write_flight_chunks(fname, [flight], len(flight), sim, binary)
+
+
+def write_flight_chunks(fname, chunks, no_frames, sim, binary=None):
+
+	'''
+	Saves a flight given as consecutive chunks of rows, so the whole flight never has to be in memory
+	Args:
+		fname: the name to save the flight as
+		chunks: iterable of (frames x 14) arrays of the rows of the flight, in order
+		no_frames: the total number of rows in the chunks, for the binary header
+		sim: the simulation code, saved in the header
+		binary: optional, save in the binary format. Default is binary for file names ending in FLIGHT_EXT
+	'''
+	if binary is None:
+		binary = os.path.splitext(fname)[1] == FLIGHT_EXT
+	written = 0
+	with open(fname, "wb") as ffile:
+		if binary:
+			ffile.write(FLIGHT_HEADER.pack(FLIGHT_MAGIC, FLIGHT_VERSION, FLIGHT_DTYPE.itemsize, no_frames, sim[:40]))
+		for chunk in chunks:
+			chunk = np.asarray(chunk, dtype="<f8").reshape(-1, 14)
+			with profiling.stage("write", len(chunk)):
+				if binary:
+					ffile.write(np.ascontiguousarray(chunk).tostring())
+				else:
+					np.savetxt(ffile, chunk, fmt=FLIGHT_TEXT_FMT, header=sim if written == 0 else "")
+			written += len(chunk)
+		if not binary and written == 0:
+			np.savetxt(ffile, np.empty((0, 14)), fmt=FLIGHT_TEXT_FMT, header=sim)
+	if written != no_frames:
+		raise ValueError("%i frames were written to %s, %i were expected" % (written, fname, no_frames))
+
+
+def read_flight_cached(fname):
+
+	'''
+	Loads a flight file in to memory, keeping the last few loaded so a flight that is drawn again and again,
+	eg in the GUI, is only read again once the file changes
+	Args:
+		fname: the flight file
+	Returns:
+		flight: the (frames x 14) array of the flight, as from read_flight_file. Shared, so don't change it
+	'''
+	path = os.path.abspath(fname)
+	stat = os.stat(path)
+	stamp = (stat.st_mtime, stat.st_size)
+	cached = _flight_cache.pop(path, None)
+	if cached is None or cached[0] != stamp:
+		#read in rather than memory mapped, as the file may be rewritten in place while it is cached
+		cached = (stamp, read_flight_file(path, mmap_mode=None)[0])
+	_flight_cache[path] = cached
+	while len(_flight_cache) > FLIGHT_CACHE_SIZE:
+		_flight_cache.popitem(last=False)
+	return cached[1]
+
+
+def is_binary_flight(fname):
+	''' True if fname is in the binary flight format rather than text '''
+	with open(fname, "rb") as ffile:
+		return ffile.read(len(FLIGHT_MAGIC)) == FLIGHT_MAGIC
+
+
+def read_flight_file(fname, mmap_mode="r", records=False):
+
+	'''
+	Loads a flight file, working out if it is text or binary. Binary files are memory mapped, so frame ranges can
+	be sliced out of long flights without reading the rest
+	Args:
+		fname: the flight file
+		mmap_mode: optional, how to memory map binary files, None reads them in to memory
+		records: optional, return the frames as records of FLIGHT_DTYPE rather than rows of 14 columns
+	Returns:
+		flight: the (frames x 14) array of frame, expansion factor, coordinates, x_basis, y_basis, z_basis
+		sim: the simulation code from the header, None if the file doesn't have one
+	'''
+	if is_binary_flight(fname):
+		with open(fname, "rb") as ffile:
+			header = ffile.read(FLIGHT_HEADER.size)
+		magic, version, itemsize, no_frames, sim = FLIGHT_HEADER.unpack(header)
+		if version != FLIGHT_VERSION or itemsize != FLIGHT_DTYPE.itemsize:
+			raise ValueError("%s is flight format version %i with %i byte frames, can only read version %i"
+							 % (fname, version, itemsize, FLIGHT_VERSION))
+		if os.path.getsize(fname) < FLIGHT_HEADER.size + no_frames * itemsize:
+			raise ValueError("%s is truncated, the header says it has %i frames" % (fname, no_frames))
+		sim = sim.rstrip("\0")
+		if no_frames == 0:
+			#an empty file can't be memory mapped
+			flight = np.empty(0, dtype=FLIGHT_DTYPE)
+		elif mmap_mode is None:
+			with open(fname, "rb") as ffile:
+				ffile.seek(FLIGHT_HEADER.size)
+				flight = np.fromfile(ffile, dtype=FLIGHT_DTYPE, count=no_frames)
+		else:
+			flight = np.memmap(fname, dtype=FLIGHT_DTYPE, mode=mmap_mode, offset=FLIGHT_HEADER.size, shape=(no_frames,))
+	else:
+		sim = None
+		with open(fname, "r") as ffile:
+			first_line = ffile.readline()
+		if first_line.startswith("#"):
+			sim = first_line[1:].strip()
+		flight = np.loadtxt(fname, ndmin=2).astype("<f8").reshape(-1, 14).view(FLIGHT_DTYPE).ravel()
+	if records:
+		return flight, sim
+	return flight.view("<f8").reshape(-1, 14), sim
+
+
+def convert_flight_file(src, dst, binary=None):
+
+	'''
+	Converts a flight file between the text and binary formats, keeping the sim name
+	Args:
+		src: the flight file to convert, in either format
+		dst: the file to write
+		binary: optional, write the binary format. Default is binary for file names ending in FLIGHT_EXT
+	'''
+	flight, sim = read_flight_file(src)
+	write_flight_file(dst, flight, sim if sim is not None else "", binary)
 
 class Interp3D(object):
 	'''
@@ -105,6 +276,10 @@ class Interp3D(object):
 		self.x_interp = interp1d(fks, xks, fill_value="extrapolate")
 		self.y_interp = interp1d(fks, yks, fill_value="extrapolate")
 		self.z_interp = interp1d(fks, zks, fill_value="extrapolate")
+		#the gradient of each linear piece, for deriv
+		order = np.argsort(fks, kind="mergesort")
+		self.fks = fks[order]
+		self.slopes = np.diff(np.c_[xks, yks, zks][order], axis=0) / np.diff(self.fks)[:, None]
 
 	def __call__(self, frames):
 		xs = self.x_interp(frames)
@@ -112,6 +287,14 @@ class Interp3D(object):
 		zs = self.z_interp(frames)
 		return np.asarray([xs, ys, zs]).T
 
+	def deriv(self, frames):
+		'''
+		The derivative wrt frame number at the given frames, the gradient of the piece each frame is in,
+		or of the end pieces outside the knots as they are extrapolated
+		'''
+		pieces = np.clip(np.searchsorted(self.fks, np.atleast_1d(frames), side="right") - 1, 0, len(self.slopes) - 1)
+		return self.slopes[pieces]
+
 
 class Spline3D:
     '''
@@ -149,6 +332,20 @@ class Spline3D:
 		# zs = spline(self.fks, self.zks, fs)
 		return np.transpose(np.asarray([xs, ys, zs]))
 
+    def deriv(self, fs):
+		'''
+		Generates the derivative of the spline wrt frame number at given frames
+		Args:
+			fs: Frames to find the derivative at
+		Returns:
+			[[dx,dy,dz], ...] list of derivatives in order of given frames
+		'''
+		if not hasattr(self, "x_deriv"):
+			self.x_deriv = self.x_spline.derivative()
+			self.y_deriv = self.y_spline.derivative()
+			self.z_deriv = self.z_spline.derivative()
+		return np.transpose(np.asarray([self.x_deriv(fs), self.y_deriv(fs), self.z_deriv(fs)]))
+
 
 def orthonormalise(new_vects, basis_1):
 	'''
@@ -215,16 +412,14 @@ def coord_transform(x_basis, y_basis, z_basis, cam_position, particles, inv=True
 	return coords_in_cam
 
 
-def perspective_transfomation(coords_in_cam, region):
+def perspective_matrix(region):
 
 	'''
-	Applies a perspective matrix to transform to project the positions of the galaxies as the would be
-	viewed from the camera
+	Builds the perspective projection matrix for the camera
 	Args:
-		coords_in_cam: the returned positions from the coord_transform of the galaxies
 		region: the region of the box you are looking at
 	Returns:
-		coords_alt: the altered coordinated once the transforamtion has been applied
+		M_projection: the 4x4 projection matrix, acting on homogeneous camera frame coordinates
 	'''
 
 	fov = np.pi / 4
@@ -239,10 +434,23 @@ def perspective_transfomation(coords_in_cam, region):
 		(0,0,(-near-far)/(near-far), (2*near*far)/(near-far)),
 		(0,0,1,0)
 	])
+	return M_projection
 
-	#to clip aything out of the region on z
 
+def perspective_transfomation(coords_in_cam, region):
+
+	'''
+	Applies a perspective matrix to transform to project the positions of the galaxies as the would be
+	viewed from the camera
+	Args:
+		coords_in_cam: the returned positions from the coord_transform of the galaxies
+		region: the region of the box you are looking at
+	Returns:
+		coords_alt: the altered coordinated once the transforamtion has been applied, for the galaxies in
+					view only, with the index of each galaxy in coords_in_cam as the last column
+	'''
 
+	M_projection = perspective_matrix(region)
 
 	perpec_in_cam = np.dot(M_projection, coords_in_cam)
 	coords = perpec_in_cam
@@ -253,17 +461,10 @@ def perspective_transfomation(coords_in_cam, region):
 	coords[:,3] = coords[:,3]/coords[:,3]
 
 	#clips all galaxies that are not in your field of view
-	coords_alt = np.asarray([np.append(coord, index) for index, coord  in enumerate(coords) if (abs(coord[0]) <= 1) and (abs(coord[1]) <= 1) and abs(coord[2]) <= 1.
-		])
+	in_view = np.flatnonzero(np.all(np.abs(coords[:, :3]) <= 1., axis=1))
+	coords_alt = np.c_[coords[in_view], in_view]
 
 	#to transform back into distances rather than normalized, not currently functional
-	# mask = np.where(np.logical_and(np.logical_and(np.logical_and(np.logical_and(np.logical_and(
-	# 		coords[:,0] <= 1, coords[:,0] >=-1),
-	# 		coords[:,1]<=1), coords[:,1]>=-1),
-	# 		coords[:,2]<=1), coords[:,2]>=-1))
-	# coords_alt = coords[mask]
-	# print coords_alt.T
-	# print coords_alt2
 	# w_s         = region[0]
 	# h_s         = region[1]
 	# s_x         = 0.0
@@ -281,6 +482,41 @@ def perspective_transfomation(coords_in_cam, region):
 	return coords_alt
 
 
+def project_galaxies(x_basis, y_basis, z_basis, cam_position, particles, region):
+
+	'''
+	Transforms the galaxies in to the camera frame and projects them in one go, the same as
+	coord_transform followed by perspective_transfomation but without the homogeneous 4xN coordinates
+	Args:
+		x_basis, y_basis, z_basis: the camera basis vectors
+		cam_position: a list containing the x,y and z coordinate of the current camera position
+		particles: a numpy array of all the galaxies coordinates
+		region: the region of the box you are looking at
+	Returns:
+		in_view: the indices in to particles of the galaxies in the field of view
+		coords_proj: the projected, normalised x,y,z of those galaxies
+		coords_in_cam: the camera frame coordinates of those galaxies
+	'''
+
+	#the inverse of the camera to world rotation takes world offsets in to the camera frame
+	with profiling.stage("transform", len(particles)):
+		M_camera = np.linalg.inv(np.array([x_basis, y_basis, z_basis]).T)
+		coords_in_cam = np.dot(np.asarray(particles) - np.asarray(cam_position), M_camera.T)
+	M_projection = perspective_matrix(region)
+
+	with profiling.stage("projection", len(particles)):
+		w = coords_in_cam[:, 2]
+		with np.errstate(divide="ignore", invalid="ignore"):
+			proj_xs = M_projection[0, 0] * coords_in_cam[:, 0] / w
+			proj_ys = M_projection[1, 1] * coords_in_cam[:, 1] / w
+			proj_zs = (M_projection[2, 2] * w + M_projection[2, 3]) / w
+
+		#clips all galaxies that are not in your field of view
+		in_view = np.flatnonzero((np.abs(proj_xs) <= 1.) & (np.abs(proj_ys) <= 1.) & (np.abs(proj_zs) <= 1.))
+		coords_proj = np.c_[proj_xs[in_view], proj_ys[in_view], proj_zs[in_view]]
+	return in_view, coords_proj, coords_in_cam[in_view]
+
+
 def find_snapnums(scale_factor):
 
 	'''
@@ -314,35 +550,148 @@ def find_snapnums(scale_factor):
 	return [beforeSnap, afterSnap]
 
 
+def find_snapnum_pairs(scale_factors):
+
+	'''
+	An array version of find_snapnums, giving the snapnumbers either side of many scale factors at once
+	Args:
+		scale_factors: The expansion factors of interest
+
+	Returns: An (N x 2) array where each row is [beforeSnap, afterSnap] for the matching scale factor,
+			 with the same values find_snapnums would give
+
+	'''
+
+	scale_factors = np.asarray(scale_factors, dtype=float)
+	after_snaps = np.searchsorted(Expansion_F_snaps, scale_factors)
+	exact = np.zeros(len(scale_factors), dtype=bool)
+	in_range = after_snaps < len(Expansion_F_snaps)
+	exact[in_range] = Expansion_F_snaps[after_snaps[in_range]] == scale_factors[in_range]
+	before_snaps = np.where(exact, after_snaps, after_snaps - 1)
+	return np.c_[before_snaps, after_snaps]
+
+
+def find_snapnum_range(scale_factors):
+
+	'''
+	Gives every snapshot number needed to interpolate galaxies over a set of scale factors
+	Args:
+		scale_factors: The expansion factors of interest, eg every frame of a flight
+
+	Returns: An array of the snapshot numbers from the snapshot before the smallest scale factor
+			 to the snapshot after the largest one, plus the one after that as it holds the
+			 descendants of the last
+
+	'''
+
+	first_snap = find_snapnums(np.min(scale_factors))[0]
+	last_snap = find_snapnums(np.max(scale_factors))[1] + 1
+	return np.arange(max(first_snap, 0), min(last_snap, len(Expansion_F_snaps) - 1) + 1)
+
+
+class TreeIndex(object):
+	'''
+	A one-time index over a merger tree pull, for matching galaxies to their descendants
+	without scanning the whole table each frame. Rows are sorted by snapshot and then ID, so each
+	snapshot is a contiguous block and descendants can be found with searchsorted. Data that is
+	already sorted, as from the tree store, is used as it is, so memory mapped columns stay shared.
+	One index can be shared between threads, eg a story board and the GUI's frame previews.
+	'''
+	def __init__(self, dbs_data, min_mass=1e10, max_pairs=4):
+		'''
+		Args:
+			dbs_data: the pulled merger tree data, with ID, DesID, SnapNum and MassType_DM columns.
+					  A record array, or a DBS.treestore.TreeColumns
+			min_mass: the smallest DM mass of galaxy to interpolate
+			max_pairs: how many snapshot pairs to keep matched galaxies cached for
+		'''
+		snapnums = np.asarray(dbs_data['SnapNum'])
+		ids = np.asarray(dbs_data['ID'])
+		self.dbs_data = dbs_data
+		self.min_mass = min_mass
+		self.max_pairs = max_pairs
+		if getattr(dbs_data, "sorted_by", ())[:2] == ("SnapNum", "ID"):
+			#None for the rows already being in order
+			self.order = None
+			self.sorted_ids = ids
+			self.snap_starts = np.searchsorted(snapnums, np.arange(len(Expansion_F_snaps) + 1))
+		else:
+			self.order = np.lexsort((ids, snapnums))
+			self.sorted_ids = ids[self.order]
+			self.snap_starts = np.searchsorted(snapnums[self.order], np.arange(len(Expansion_F_snaps) + 1))
+		self.pairs = OrderedDict()
+		self.pairs_lock = threading.Lock()
+
+	def snap_slice(self, snapnum):
+		'''The slice of the sorted rows that are in snapshot snapnum'''
+		if snapnum < 0 or snapnum >= len(Expansion_F_snaps):
+			return slice(0, 0)
+		return slice(self.snap_starts[snapnum], self.snap_starts[snapnum + 1])
+
+	def sorted_rows(self, rows):
+		'''The rows of dbs_data at the positions rows, a slice or array, of the sorted rows'''
+		if self.order is None:
+			return np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows
+		return self.order[rows]
+
+	def pair(self, beforeSnap, afterSnap):
+		'''
+		Matches the galaxies of one snapshot to their descendants in the next
+		Args:
+			beforeSnap, afterSnap: the snapshot numbers either side of the scale factor
+		Returns:
+			beforeGals, afterGals: record arrays where afterGals[i] is the descendant of beforeGals[i]
+		'''
+		with self.pairs_lock:
+			key = (beforeSnap, afterSnap)
+			if key in self.pairs:
+				#move to the back so it is the last to be dropped
+				self.pairs[key] = self.pairs.pop(key)
+				return self.pairs[key]
+			self.pairs[key] = self.match(beforeSnap, afterSnap)
+			if len(self.pairs) > self.max_pairs:
+				self.pairs.popitem(last=False)
+			return self.pairs[key]
+
+	def match(self, beforeSnap, afterSnap):
+		'''Matches the galaxies as pair does, without caching them'''
+		before_rows = self.sorted_rows(self.snap_slice(beforeSnap))
+		before_rows = before_rows[np.asarray(self.dbs_data['MassType_DM'])[before_rows] >= self.min_mass]
+		beforeGals = self.dbs_data[before_rows]
+		if beforeSnap == afterSnap:
+			afterGals = beforeGals
+		else:
+			after_slice = self.snap_slice(afterSnap)
+			after_ids = self.sorted_ids[after_slice]
+			des_pos = np.searchsorted(after_ids, beforeGals['DesID'])
+			found = des_pos < len(after_ids)
+			found[found] = after_ids[des_pos[found]] == beforeGals['DesID'][found]
+			beforeGals = beforeGals[found]
+			afterGals = self.dbs_data[self.sorted_rows(after_slice.start + des_pos[found])]
+		return beforeGals, afterGals
+
+
 def gal_interpolation(scale_factor, dbs_data):
 
 	'''
 	Interpolates the galaxies linearly to find a position between snapnumbers
 	Args:
 		scale_factor:the scale factor at the current frame
-		dbs_data: the entire pulled data from the sql
+		dbs_data: the entire pulled data from the sql, or a TreeIndex of it. Pass a TreeIndex
+				  when interpolating many frames so the galaxy matching is only done once
 	Returns:
 		interpGals: a numpy array of the interpolated galaxiesin the form
 					ID,Snampnum,Mass(DM),x,y,z,redshift
 	'''
 
-	#get working for one gal, may be give id or something
-
-
+	if not isinstance(dbs_data, TreeIndex):
+		dbs_data = TreeIndex(dbs_data)
 
 	sideSnaps = find_snapnums(scale_factor)
 	beforeSnap, afterSnap = sideSnaps[0], sideSnaps[1]
 
-	#galaxies of the before snapshots
-	# mask_B = np.where(dbs_data['SnapNum'] == beforeSnap)
-	mask_B = np.where(np.logical_and(dbs_data['SnapNum'] == beforeSnap, dbs_data['MassType_DM'] >= 1e10))
-	beforeGals = dbs_data[mask_B]
-
-	mask_After = np.where(np.in1d( dbs_data['ID'], beforeGals['DesID']))
-	afterGals = dbs_data[mask_After]
-
-	mask_c = np.where(np.in1d( afterGals['ID'],beforeGals['DesID']))
-	beforeGals = beforeGals[mask_c]
+	#galaxies of the before snapshot, matched to their descendants in the after snapshot
+	beforeGals, afterGals = dbs_data.pair(beforeSnap, afterSnap)
 
 	if beforeSnap == afterSnap:
 		interpGals = np.asarray([ beforeGals['ID'],beforeGals['SnapNum'],beforeGals['MassType_DM'],(beforeGals['x']),
@@ -361,6 +710,54 @@ def gal_interpolation(scale_factor, dbs_data):
 
 	return interpGals
 
+#the most frames batch_gal_interpolation puts in a block by default
+BATCH_FRAMES = 256
+
+def batch_gal_interpolation(scale_factors, dbs_data, max_frames=BATCH_FRAMES):
+
+	'''
+	Interpolates the galaxies for many frames at once. Consecutive frames between the same pair of
+	snapshots share one matched set of galaxies, and their positions are found in one operation
+	Args:
+		scale_factors: the scale factor at every frame
+		dbs_data: the entire pulled data from the sql, or a TreeIndex of it
+		max_frames: the most frames in a yielded block, this bounds memory to max_frames x galaxies x 3
+	Yields:
+		frame_indices: the indices in to scale_factors of the frames in the block
+		galaxies: a numpy array of the galaxies for the block in the same form as gal_interpolation,
+				  ID,Snampnum,Mass(DM),x,y,z,redshift with x,y,z at the before snapshot
+		positions: a (frames x galaxies x 3) array of the interpolated positions at each frame
+	'''
+
+	if not isinstance(dbs_data, TreeIndex):
+		dbs_data = TreeIndex(dbs_data)
+	scale_factors = np.asarray(scale_factors, dtype=float)
+	snap_pairs = find_snapnum_pairs(scale_factors)
+	#split the frames in to runs that share a snapshot pair
+	run_starts = np.flatnonzero(np.any(snap_pairs[1:] != snap_pairs[:-1], axis=1)) + 1
+	run_bounds = np.r_[0, run_starts, len(scale_factors)]
+
+	for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+		beforeSnap, afterSnap = snap_pairs[run_start]
+		beforeGals, afterGals = dbs_data.pair(beforeSnap, afterSnap)
+		galaxies = np.asarray([ beforeGals['ID'],beforeGals['SnapNum'],beforeGals['MassType_DM'],beforeGals['x'],
+							beforeGals['y'],beforeGals['z'],beforeGals['Redshift']], dtype=float).T
+		before_coords = galaxies[:, 3:6]
+		moving = beforeSnap != afterSnap and len(galaxies) > 0
+		if moving:
+			delta_coords = np.array([afterGals['x'] - beforeGals['x'], afterGals['y'] - beforeGals['y'],
+									 afterGals['z'] - beforeGals['z']]).T
+			delta_time = Expansion_F_snaps[afterSnap] - Expansion_F_snaps[beforeSnap]
+
+		for block_start in range(run_start, run_end, max_frames):
+			frame_indices = np.arange(block_start, min(block_start + max_frames, run_end))
+			if moving:
+				fracTime = (scale_factors[frame_indices] - Expansion_F_snaps[beforeSnap]) / delta_time
+				positions = before_coords[None, :, :] + fracTime[:, None, None] * delta_coords[None, :, :]
+			else:
+				positions = np.repeat(before_coords[None, :, :], len(frame_indices), axis=0)
+			yield frame_indices, galaxies, positions
+
 def get_centre(basis_vectors, cam_position, region):
 	""" Return centre as seen from the camera. """
 	bv = basis_vectors
@@ -371,6 +768,79 @@ def get_centre(basis_vectors, cam_position, region):
 	return np.dot(M, np.array([0,0,region[2]/2.,1]))[:-1]
 
 
+def frustum_radius(region):
+	""" Return the radius of a sphere about get_centre that holds the camera's whole view frustum. """
+	M_projection = perspective_matrix(region)
+	far = region[2]
+	#half width and height of the far plane, and half the depth
+	return np.sqrt((far / M_projection[0, 0])**2 + (far / M_projection[1, 1])**2 + (far / 2.)**2)
+
+
+class PeriodicGrid(object):
+	"""
+	A uniform grid of cells over the periodic box, to find the points near a position
+	without looking at every point. Cells are found modulo the box, so queries near
+	an edge pick up the points from the far side of the box as well.
+	"""
+	def __init__(self, pos, boxsize, cell_size):
+		self.boxsize = boxsize
+		self.n_cells = int(max(boxsize // cell_size, 1))
+		self.cell_size = boxsize / float(self.n_cells)
+		#mod can round up to exactly boxsize, so clip back in to the last cell
+		cells = np.clip(np.floor(np.mod(pos, boxsize) / self.cell_size).astype(int), 0, self.n_cells - 1)
+		cell_ids = (cells[:, 0] * self.n_cells + cells[:, 1]) * self.n_cells + cells[:, 2]
+		self.order = np.argsort(cell_ids, kind="mergesort")
+		self.cell_starts = np.searchsorted(cell_ids[self.order], np.arange(self.n_cells**3 + 1))
+
+	def query_sphere(self, centre, radius):
+		"""
+		Return the sorted indices of every point within radius of centre, plus those
+		in the same cells that are a little further away.
+		"""
+		axes = []
+		for low, high in zip(np.floor((np.asarray(centre) - radius) / self.cell_size).astype(int),
+							 np.floor((np.asarray(centre) + radius) / self.cell_size).astype(int)):
+			if high - low + 1 >= self.n_cells:
+				axes.append(np.arange(self.n_cells))
+			else:
+				axes.append(np.mod(np.arange(low, high + 1), self.n_cells))
+		ids = ((axes[0][:, None, None] * self.n_cells + axes[1][None, :, None]) * self.n_cells
+			   + axes[2][None, None, :]).ravel()
+		starts = self.cell_starts[ids]
+		lengths = self.cell_starts[ids + 1] - starts
+		#gather every cell's run of sorted points in one go
+		offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+		return np.sort(self.order[offsets + np.arange(lengths.sum())])
+
+
+class FrustumCuller(object):
+	"""
+	Pre-culls the galaxies of one block of frames from batch_gal_interpolation down to
+	those that could be in the camera's view, before any exact transform is done.
+	The galaxies are put in a PeriodicGrid at their first frame position. The few that
+	move more than a fraction of a cell over the block are always kept as candidates.
+	"""
+	def __init__(self, positions, boxsize, region):
+		self.radius = frustum_radius(region)
+		self.all = np.arange(positions.shape[1])
+		#the sphere covers the whole box, nothing can be culled
+		self.cull = self.radius < boxsize / 2.
+		if self.cull:
+			self.grid = PeriodicGrid(positions[0], boxsize, max(self.radius / 2., boxsize / 64.))
+			self.margin = self.grid.cell_size / 2.
+			drift = np.sqrt(np.sum((positions[-1] - positions[0])**2, axis=1))
+			self.fast = np.flatnonzero(drift > self.margin)
+
+	def candidates(self, centre):
+		""" Return the sorted indices of the galaxies that may be in view of a camera looking at centre. """
+		if not self.cull:
+			return self.all
+		near = self.grid.query_sphere(centre, self.radius + self.margin)
+		if len(self.fast) == 0:
+			return near
+		return np.union1d(near, self.fast)
+
+
 def periodic_wrap(pos, boxsize, centre=None):
 	"""
 	Wrap the coordinates in pos to the periodic copy nearest centre
@@ -387,3 +857,40 @@ def periodic_wrap(pos, boxsize, centre=None):
 		return np.mod(pos, boxsize)
 	else:
 		return np.mod(pos-centre+0.5*boxsize, boxsize)+centre-0.5*boxsize
+
+
+def periodic_intervals(coords, half_width, boxsize, max_intervals=4):
+	"""
+	Return the parts of one axis of a periodic box that are within half_width of any of coords,
+	as a list of (low, high) intervals inside 0-boxsize. An interval that wraps round the edge of
+	the box is split in two. Where the parts would be more than max_intervals, the ones closest
+	together are joined, so the intervals always hold every part. None if they cover the whole axis.
+	"""
+	points = np.unique(np.mod(coords, boxsize))
+	if len(points) == 0 or 2 * half_width >= boxsize:
+		return None
+	#the gap after each point, the last wrapping round to the first
+	gaps = np.diff(np.r_[points, points[0] + boxsize])
+	breaks = np.flatnonzero(gaps > 2 * half_width)
+	if len(breaks) == 0:
+		return None
+	#keep the widest gaps
+	breaks = np.sort(breaks[np.argsort(gaps[breaks], kind="mergesort")[-max_intervals:]])
+
+	intervals = []
+	for this_break, next_break in zip(breaks, np.roll(breaks, -1)):
+		#each part runs from the point after one gap to the point before the next
+		start, end = points[(this_break + 1) % len(points)], points[next_break]
+		if end < start:
+			end += boxsize
+		low, high = start - half_width, end + half_width
+		if high - low >= boxsize:
+			return None
+		shift = np.floor(low / boxsize) * boxsize
+		low, high = low - shift, high - shift
+		if high > boxsize:
+			intervals.append((0., high - boxsize))
+			intervals.append((low, boxsize))
+		else:
+			intervals.append((low, high))
+	return sorted(intervals)